@@ -0,0 +1,20 @@
+"""
+Run every benchmark, or the ones given as arguments (e.g. ``python -m benchmarks db``). Each one runs in its own
+interpreter, because Django is configured once per process and the patches can't be undone.
+"""
+
+import pkgutil
+import subprocess
+import sys
+from pathlib import Path
+
+
+def main(names):
+    if not names:
+        names = [module.name for module in pkgutil.iter_modules([str(Path(__file__).parent)]) if module.name[0] != '_']
+    for name in names:
+        subprocess.run([sys.executable, '-m', f'benchmarks.{name}'], check=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
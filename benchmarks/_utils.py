@@ -0,0 +1,40 @@
+import timeit
+
+import django
+from django.conf import settings
+
+
+def setup(**options):
+    """
+    Configure Django for a benchmark: an in-memory sqlite database, a local memory cache and the null client, unless
+    `options` say otherwise.
+    """
+    config = {
+        'DATABASES': {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        'INSTALLED_APPS': ['django_statsd'],
+        'STATSD_CLIENT': 'django_statsd.clients.null',
+        'STATSD_PATCHES': [],
+    }
+    config.update(options)
+    settings.configure(**config)
+    django.setup()
+
+
+def header(title):
+    print(f'\n{title}')
+    print('-' * len(title))
+
+
+def bench(label, func, number, calls=1, baseline=None, repeat=5):
+    """
+    Print the time per call of the best of `repeat` runs of `number` calls of `func`, which makes `calls` calls itself
+    when it is a loop, and the overhead per call over `baseline`: the time per call of another benchmark. Return the
+    time per call in nanoseconds.
+    """
+    ns = min(timeit.repeat(func, number=number, repeat=repeat)) / (number * calls) * 1e9
+    line = f'{label:<48} {ns:8.0f} ns/call'
+    if baseline is not None:
+        line += f'  {ns - baseline:+8.0f} ns'
+    print(line)
+    return ns
@@ -0,0 +1,64 @@
+"""
+The batch client against the normal client: the time to send a metric and the number of datagrams (``sendto`` calls),
+for requests that each send 50 metrics to a local UDP socket and are flushed at the end, like the request timing
+middleware does.
+"""
+
+import socket
+import time
+
+from benchmarks._utils import header, setup
+
+setup()
+
+from statsd.client import StatsClient  # noqa: E402
+
+from django_statsd.clients import close_client  # noqa: E402
+from django_statsd.clients.batch import StatsClient as BatchStatsClient  # noqa: E402
+
+REQUESTS = 2_000
+METRICS_PER_REQUEST = 50
+
+
+def run(client):
+    """
+    Send the metrics of `REQUESTS` requests, and return the time per metric in nanoseconds and the number of datagrams.
+    """
+    datagrams = 0
+    send = client._send
+
+    def counted_send(data):
+        nonlocal datagrams
+        datagrams += 1
+        send(data)
+
+    client._send = counted_send
+    flush = getattr(client, 'flush', lambda: None)
+    start = time.perf_counter_ns()
+    for _ in range(REQUESTS):
+        for i in range(METRICS_PER_REQUEST):
+            client.timing(f'db.sqlite3.default.execute.{i}', 1.5)
+        flush()
+    ns = (time.perf_counter_ns() - start) / (REQUESTS * METRICS_PER_REQUEST)
+    return ns, datagrams
+
+
+def main():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver:
+        # Nothing reads from the socket, the datagrams that don't fit in its buffer are dropped by the kernel.
+        receiver.bind(('127.0.0.1', 0))
+        port = receiver.getsockname()[1]
+
+        header(f'{REQUESTS} requests of {METRICS_PER_REQUEST} timings')
+        clients = [('normal client', StatsClient('127.0.0.1', port))]
+        for maxudpsize in (512, 1432, 8932):
+            client = BatchStatsClient('127.0.0.1', port, maxudpsize=maxudpsize, flush_interval=0)
+            clients.append((f'batch client, maxudpsize={maxudpsize}', client))
+        for label, client in clients:
+            ns, datagrams = run(client)
+            print(f'{label:<48} {ns:8.0f} ns/metric {datagrams:8} datagrams')
+            close_client(client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+The cost of the cache instrumentation: 1M ``get`` calls that hit a local memory cache, without instrumentation, with
+the former `StatsdTracker` and with the `CacheTracker`, with the null client. The `CacheTracker` also counts the hit,
+which is sent right away outside of a request and summed during one. And the cost of reading an attribute that isn't
+a method, which the `StatsdTracker` wrapped as well.
+"""
+
+from benchmarks._utils import bench, header, setup
+
+setup()
+
+from django.core.cache.backends.locmem import LocMemCache  # noqa: E402
+
+from django_statsd import aggregation  # noqa: E402
+from django_statsd.patches.cache import CacheTracker, StatsdTracker  # noqa: E402
+
+CALLS = 1_000_000
+
+
+def run(cache, number):
+    for _ in range(number):
+        cache.get('key')
+
+
+def main():
+    backend = LocMemCache('bench', {})
+    backend.set('key', 'value')
+    former = StatsdTracker(backend)
+    tracker = CacheTracker(backend, 'default')
+
+    header(f'{CALLS} x cache.get hitting a LocMemCache, per call')
+    plain = bench('LocMemCache', lambda: run(backend, CALLS), 1, calls=CALLS, repeat=1)
+    bench('StatsdTracker (the former patch)', lambda: run(former, CALLS), 1, calls=CALLS, baseline=plain, repeat=1)
+    bench('CacheTracker', lambda: run(tracker, CALLS), 1, calls=CALLS, baseline=plain, repeat=1)
+    aggregation.count_cache_hits()
+    bench('CacheTracker, during a request', lambda: run(tracker, CALLS), 1, calls=CALLS, baseline=plain, repeat=1)
+    aggregation.stop_counting_cache_hits()
+
+    header('cache.key_prefix')
+    plain = bench('LocMemCache', lambda: backend.key_prefix, CALLS)
+    bench('StatsdTracker (the former patch)', lambda: former.key_prefix, CALLS, baseline=plain)
+    bench('CacheTracker', lambda: tracker.key_prefix, CALLS, baseline=plain)
+
+
+if __name__ == '__main__':
+    main()
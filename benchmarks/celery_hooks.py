@@ -0,0 +1,76 @@
+"""
+The cost of the Celery signal handlers for a short task (``task_prerun``, ``task_success`` and ``task_postrun``), with
+the null client: the keys of the task alone, built on every event like the former handlers did or taken from the
+`TaskKeyRegistry`, and the handlers themselves. The current handlers also send the queue wait, the end-to-end time and
+the tracked task gauge, which the former ones didn't.
+"""
+
+import time
+from types import SimpleNamespace
+
+from benchmarks._utils import bench, header, setup
+
+setup()
+
+from django_statsd import celery_hooks  # noqa: E402
+from django_statsd.celery_hooks import TaskKeyRegistry  # noqa: E402
+from django_statsd.clients import statsd  # noqa: E402
+
+CALLS = 100_000
+
+_task_start_times = {}
+
+
+def former_prerun(sender=None, task_id=None, **kwds):
+    statsd.incr('celery.{}.start'.format(sender.name.replace('.', '_')))
+    _task_start_times[task_id] = time.time()
+
+
+def former_postrun(sender=None, task_id=None, **kwds):
+    statsd.incr('celery.{}.done'.format(sender.name.replace('.', '_')))
+    start_time = _task_start_times.pop(task_id, False)
+    if start_time:
+        ms = int((time.time() - start_time) * 1000)
+        statsd.timing('celery.{}.runtime'.format(sender.name.replace('.', '_')), ms)
+
+
+def former_success(sender=None, **kwds):
+    statsd.incr('celery.{}.success'.format(sender.name.replace('.', '_')))
+
+
+def run_task(prerun, success, postrun, task):
+    prerun(sender=task, task_id='id')
+    success(sender=task)
+    postrun(sender=task, task_id='id')
+
+
+def main():
+    task = SimpleNamespace(
+        name='myapp.tasks.send_notification',
+        request=SimpleNamespace(delivery_info={'routing_key': 'notifications'}, headers={}),
+    )
+
+    header('The start, done, runtime and success keys of a task')
+    bench(
+        'str.format per event (the former handlers)',
+        lambda: [f'celery.{task.name.replace(".", "_")}.{event}' for event in ('start', 'done', 'runtime', 'success')],
+        CALLS,
+    )
+    registry = TaskKeyRegistry()
+    bench('TaskKeyRegistry', lambda: registry.get(task.name), CALLS)
+    per_queue = TaskKeyRegistry(
+        template='{prefix}celery.{queue}.{task}.{event}', queue_prefixes={'notifications': 'n.'}
+    )
+    bench('TaskKeyRegistry, per queue', lambda: per_queue.get(task.name, 'notifications'), CALLS)
+
+    header('The handlers of a task: prerun, success and postrun')
+    bench('former handlers', lambda: run_task(former_prerun, former_success, former_postrun, task), CALLS)
+    bench(
+        'celery_hooks',
+        lambda: run_task(celery_hooks.on_task_prerun, celery_hooks.on_task_success, celery_hooks.on_task_postrun, task),
+        CALLS,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+The cost of the database instrumentation: 100k trivial queries on sqlite, without instrumentation, with the execute
+wrapper (``django_statsd.patches.db_wrapper``) and with the patched CursorWrapper (``django_statsd.patches.db``), and
+the cost of finding the type of a large query.
+"""
+
+from benchmarks._utils import bench, header, setup
+
+setup()
+
+from django.db import connections  # noqa: E402
+from django.db.backends import utils  # noqa: E402
+
+from django_statsd.patches import db, db_wrapper  # noqa: E402
+
+# The connection itself, as connection_created passes it, not the per-thread proxy of django.db.connection.
+connection = connections['default']
+
+QUERIES = 100_000
+
+# An insert with a 1 MB values list.
+LARGE_QUERY = 'INSERT INTO t (a) VALUES ' + ', '.join(['(1)'] * 200_000)
+
+
+def run(number):
+    with connection.cursor() as cursor:
+        for _ in range(number):
+            cursor.execute('SELECT 1')
+
+
+def main():
+    header(f'{QUERIES} x SELECT 1 on sqlite, per query')
+    connection.ensure_connection()
+    plain = bench('no instrumentation', lambda: run(QUERIES), 1, calls=QUERIES, repeat=3)
+
+    db_wrapper.install(connection)
+    bench('execute wrapper (patches.db_wrapper)', lambda: run(QUERIES), 1, calls=QUERIES, baseline=plain, repeat=3)
+    connection.execute_wrappers.clear()
+
+    originals = {name: vars(utils.CursorWrapper)[name] for name in ('execute', 'executemany', 'callproc')}
+    db.patch()
+    bench('patched CursorWrapper (patches.db)', lambda: run(QUERIES), 1, calls=QUERIES, baseline=plain, repeat=3)
+    for name, method in originals.items():
+        setattr(utils.CursorWrapper, name, method)
+
+    header(f'Query type of a {len(LARGE_QUERY) // 1000} kB query')
+    bench('split on whitespace (the former _get_query_type)', lambda: LARGE_QUERY.split(None, 1)[0].lower(), 1000)
+    bench('leading token only (_get_query_type)', lambda: db._get_query_type(LARGE_QUERY), 1000)
+
+
+if __name__ == '__main__':
+    main()
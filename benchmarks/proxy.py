@@ -0,0 +1,64 @@
+"""
+The cost of sending a metric through ``StatsdClientProxy``, over calling the client directly, compared with the proxy
+that checked the settings and the refresh time with datetimes on every attribute access. The null client is used, so
+only the proxy is measured.
+"""
+
+from datetime import datetime, timedelta
+from importlib import import_module
+
+from benchmarks._utils import bench, header, setup
+
+setup()
+
+from django.conf import settings  # noqa: E402
+
+from django_statsd.clients import StatsdClientProxy  # noqa: E402
+from django_statsd.clients.null import StatsClient  # noqa: E402
+
+CALLS = 200_000
+
+
+class DatetimeClientProxy:
+    """
+    The former proxy, which read the settings and compared datetimes on every attribute access.
+    """
+
+    _client = None
+
+    def __getattribute__(self, name):
+        if name == '_client':
+            return super().__getattribute__(name)
+
+        refresh_cutoff = datetime.now() - timedelta(seconds=getattr(settings, 'STATSD_REFRESH_SECONDS', 120))
+        if self._client is None or not hasattr(self._client, 'created_at') or self._client.created_at < refresh_cutoff:
+            client = getattr(settings, 'STATSD_CLIENT', 'statsd.client')
+            host = getattr(settings, 'STATSD_HOST', 'localhost')
+            port = getattr(settings, 'STATSD_PORT', 8125)
+            prefix = getattr(settings, 'STATSD_PREFIX', None)
+            self._client = import_module(client).StatsClient(host=host, port=port, prefix=prefix)
+            self._client.created_at = datetime.now()
+
+        return self._client.__getattribute__(name)
+
+
+def main():
+    client = StatsClient('localhost', 8125)
+    proxy = StatsdClientProxy()
+    former = DatetimeClientProxy()
+
+    header('statsd.incr(key) with the null client')
+    direct = bench('client', lambda: client.incr('view.GET'), CALLS)
+    bench('StatsdClientProxy', lambda: proxy.incr('view.GET'), CALLS, baseline=direct)
+    bench('former proxy (datetime and settings per call)', lambda: former.incr('view.GET'), CALLS, baseline=direct)
+
+    header('statsd.timing(key, ms) with the null client')
+    direct = bench('client', lambda: client.timing('view.GET', 1.5), CALLS)
+    bench('StatsdClientProxy', lambda: proxy.timing('view.GET', 1.5), CALLS, baseline=direct)
+    bench(
+        'former proxy (datetime and settings per call)', lambda: former.timing('view.GET', 1.5), CALLS, baseline=direct
+    )
+
+
+if __name__ == '__main__':
+    main()
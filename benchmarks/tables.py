@@ -0,0 +1,59 @@
+"""
+The cost of finding the table of a query, for statements like the ones the ORM runs: parsed every time, or looked up
+in the cache of `get_table` because the statement was seen before. And the cost of the table timings per query, with
+the execute wrapper on sqlite.
+"""
+
+from benchmarks._utils import bench, header, setup
+
+setup()
+
+from django.db import connections  # noqa: E402
+
+from django_statsd.patches import db, db_wrapper  # noqa: E402
+from django_statsd.sql import get_table  # noqa: E402
+
+# The connection itself, as connection_created passes it, not the per-thread proxy of django.db.connection.
+connection = connections['default']
+
+CALLS = 100_000
+QUERIES = 20_000
+
+STATEMENTS = [
+    'SELECT "auth_user"."id", "auth_user"."password", "auth_user"."last_login", "auth_user"."is_superuser", '
+    '"auth_user"."username", "auth_user"."first_name", "auth_user"."last_name", "auth_user"."email", '
+    '"auth_user"."is_staff", "auth_user"."is_active", "auth_user"."date_joined" FROM "auth_user" '
+    'WHERE "auth_user"."id" = %s LIMIT 21',
+    'INSERT INTO "django_session" ("session_key", "session_data", "expire_date") VALUES (%s, %s, %s)',
+    'UPDATE "orders_order" SET "status" = %s, "updated_at" = %s WHERE "orders_order"."id" = %s',
+    'SAVEPOINT "s140_x1"',
+]
+
+
+def run(number):
+    with connection.cursor() as cursor:
+        for _ in range(number):
+            cursor.execute('SELECT 1 FROM statsd_bench')
+
+
+def main():
+    parse = get_table.__wrapped__
+
+    header('get_table of an ORM statement')
+    for statement in STATEMENTS:
+        words = statement.split(None, 1)[0]
+        parsed = bench(f'{words}, parsed', lambda: parse(statement), CALLS)
+        get_table(statement)
+        bench(f'{words}, cached', lambda: get_table(statement), CALLS, baseline=parsed)
+
+    header(f'{QUERIES} x SELECT 1 FROM a table on sqlite, per query')
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TABLE statsd_bench (a integer)')
+    db_wrapper.install(connection)
+    plain = bench('execute wrapper', lambda: run(QUERIES), 1, calls=QUERIES, repeat=3)
+    db.TABLE_METRICS = True
+    bench('execute wrapper with table timings', lambda: run(QUERIES), 1, calls=QUERIES, baseline=plain, repeat=3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+from collections import defaultdict
+from contextvars import ContextVar
+
+from statsd.client import Timer
+
+from django_statsd import tags
+
+_current = ContextVar('statsd_aggregator', default=None)
+_queries = ContextVar('statsd_queries', default=None)
+_cache_hits = ContextVar('statsd_cache_hits', default=None)
+
+
+def activate(timers=False):
+    """
+    Start aggregating the metrics that are sent in the current context.
+    """
+    aggregator = RequestAggregator(timers=timers)
+    _current.set(aggregator)
+    return aggregator
+
+
+def deactivate():
+    """
+    Stop aggregating the metrics that are sent in the current context.
+    """
+    _current.set(None)
+
+
+def get_aggregator():
+    return _current.get()
+
+
+def count_queries():
+    """
+    Start counting the database queries that are run in the current context.
+    """
+    stats = QueryStats()
+    _queries.set(stats)
+    return stats
+
+
+def stop_counting_queries():
+    """
+    Stop counting the database queries that are run in the current context.
+    """
+    _queries.set(None)
+
+
+def record_query(query_type, ms):
+    """
+    Count a database query, if the queries are counted in the current context, and return whether it was counted.
+    """
+    stats = _queries.get()
+    if stats is None:
+        return False
+    stats.add(query_type, ms)
+    return True
+
+
+def count_cache_hits():
+    """
+    Start summing the cache hits and misses in the current context, instead of sending each of them.
+    """
+    hits = CacheHits()
+    _cache_hits.set(hits)
+    return hits
+
+
+def stop_counting_cache_hits():
+    """
+    Stop summing the cache hits and misses in the current context.
+    """
+    _cache_hits.set(None)
+
+
+def get_cache_hits():
+    return _cache_hits.get()
+
+
+class RequestAggregator:
+    """
+    Collects the metrics sent during a request, so every distinct key is sent once when the request is done.
+
+    Counters are summed into a single ``incr``. With `timers`, the timings of a key are collapsed into ``<key>.count``,
+    ``<key>.sum`` and ``<key>.max``. Every call is counted, whatever its sample rate, so the totals are exact.
+    """
+
+    def __init__(self, timers=False):
+        self.counters = defaultdict(int)
+        self.timers = {}
+        self.methods = {'incr': self.incr, 'decr': self.decr}
+        if timers:
+            self.methods.update(timing=self.timing, timer=self.timer)
+
+    def incr(self, stat, count=1, rate=1):
+        self.counters[stat] += count
+
+    def decr(self, stat, count=1, rate=1):
+        self.counters[stat] -= count
+
+    def timing(self, stat, delta, rate=1):
+        try:
+            timer = self.timers[stat]
+        except KeyError:
+            self.timers[stat] = [1, delta, delta]
+        else:
+            timer[0] += 1
+            timer[1] += delta
+            if delta > timer[2]:
+                timer[2] = delta
+
+    def timer(self, stat, rate=1):
+        return Timer(self, stat, rate)
+
+    def flush(self, client):
+        """
+        Send the aggregated metrics through `client`.
+        """
+        for stat, count in self.counters.items():
+            if count:
+                client.incr(stat, count)
+        for stat, (count, total, maximum) in self.timers.items():
+            client.incr(tags.suffixed(stat, 'count'), count)
+            client.timing(tags.suffixed(stat, 'sum'), total)
+            client.timing(tags.suffixed(stat, 'max'), maximum)
+        self.counters.clear()
+        self.timers.clear()
+
+
+class QueryStats:
+    """
+    The database queries of a request: their number, their total time in milliseconds and their number per type.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.types = defaultdict(int)
+
+    def add(self, query_type, ms):
+        self.count += 1
+        self.time += ms
+        self.types[query_type] += 1
+
+
+class CacheHits:
+    """
+    The cache hits and misses of a request, per cache alias.
+    """
+
+    def __init__(self):
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def add(self, alias, hits, misses):
+        if hits:
+            self.hits[alias] += hits
+        if misses:
+            self.misses[alias] += misses
+
+    def flush(self, client):
+        """
+        Send the hits and misses as ``cache.<alias>.hits`` and ``cache.<alias>.misses`` through `client`, or with the
+        alias as a tag.
+        """
+        if tags.TAG_FORMAT:
+            hits_key, misses_key = 'cache.hits;alias={}', 'cache.misses;alias={}'
+        else:
+            hits_key, misses_key = 'cache.{}.hits', 'cache.{}.misses'
+        for alias, count in self.hits.items():
+            client.incr(hits_key.format(alias), count)
+        for alias, count in self.misses.items():
+            client.incr(misses_key.format(alias), count)
+        self.hits.clear()
+        self.misses.clear()
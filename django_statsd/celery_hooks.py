@@ -1,49 +1,249 @@
+import socket
+import threading
 import time
+from collections import Counter, OrderedDict, namedtuple
+from string import Formatter
 
+from django.conf import settings
+
+from django_statsd import tags
 from django_statsd.clients import statsd
 
-_task_start_times = {}
 
+class TaskStartTimes:
+    """
+    The start times of the running tasks, by task id.
+
+    Tasks that are killed, hit a hard time limit or lose their worker process never send ``task_postrun``. Their entries
+    are evicted once they are older than `ttl` seconds, or when more than `max_size` tasks are tracked, so a long-lived
+    worker doesn't keep on growing.
+    """
+
+    def __init__(self, max_size=10000, ttl=86400):
+        self.max_size = max_size
+        self.ttl_ns = int(ttl * 1e9)
+        self._times = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._times)
+
+    def start(self, task_id, now):
+        """
+        Track the start time of a task, and return the number of evicted entries.
+        """
+        times = self._times
+        with self._lock:
+            times[task_id] = now
+            # The entries are kept oldest first, so the eviction only has to look at the front.
+            times.move_to_end(task_id)
+
+            evicted = 0
+            while len(times) > self.max_size:
+                times.popitem(last=False)
+                evicted += 1
+            cutoff = now - self.ttl_ns
+            while times and next(iter(times.values())) < cutoff:
+                times.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def stop(self, task_id):
+        """
+        Stop tracking a task and return its start time, or None if it isn't tracked.
+        """
+        with self._lock:
+            return self._times.pop(task_id, None)
+
+
+# The header that carries the time a task was published at, to measure how long it waited in the broker queue.
+PUBLISHED_AT_HEADER = 'statsd_published_at'
 
-def on_before_task_publish(sender=None, **kwds):
+
+def get_published_at(task):
+    """
+    Return the time the running `task` was published at, or None if it wasn't stamped.
+    """
+    request = getattr(task, 'request', None)
+    if request is None:
+        return None
+    # Custom headers end up on the request of a worker, but in a separate dict when the task is run eagerly.
+    published_at = getattr(request, PUBLISHED_AT_HEADER, None)
+    if published_at is None:
+        published_at = (getattr(request, 'headers', None) or {}).get(PUBLISHED_AT_HEADER)
+    return published_at
+
+
+def _ms_since(timestamp):
+    # The task is published and run on different machines, so this is wall clock time. Clock skew between them can
+    # make it negative.
+    return max((time.time() - timestamp) * 1000, 0.0)
+
+
+# The metric keys of a task: ``celery.<task>.<event>`` by default.
+TaskKeys = namedtuple(
+    'TaskKeys',
+    [
+        'before_task_publish',
+        'after_task_publish',
+        'start',
+        'done',
+        'runtime',
+        'queue_wait',
+        'end_to_end',
+        'success',
+        'failure',
+        'retry',
+        'revoked',
+        'unknown',
+    ],
+)
+
+
+class TaskKeyRegistry:
+    """
+    The metric keys of the Celery tasks, built once per task (and queue) and reused for every event after that.
+
+    `template` is formatted with ``task`` (the task name), ``event``, ``queue`` (the routing key the task was sent
+    with) and ``prefix`` (the prefix of that queue in `queue_prefixes`, or an empty string). Dots in the task and queue
+    names are replaced by underscores.
+
+    With `tagged`, the keys are ``celery.<event>`` with the task name as a tag, and the queue as well when `template`
+    depends on it.
+    """
+
+    def __init__(self, template='celery.{task}.{event}', queue_prefixes=None, tagged=False):
+        self.template = template
+        self.queue_prefixes = queue_prefixes or {}
+        self.tagged = tagged
+        fields = {field for _, field, _, _ in Formatter().parse(template) if field}
+        # Only look up the queue of a task when the keys depend on it.
+        self.per_queue = bool(fields & {'queue', 'prefix'})
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, task_name, queue=None):
+        """
+        Return the `TaskKeys` of a task that was sent to `queue`.
+        """
+        if not self.per_queue:
+            queue = None
+        try:
+            return self._keys[task_name, queue]
+        except KeyError:
+            keys = self._keys[task_name, queue] = self.build(task_name, queue)
+            return keys
+
+    def build(self, task_name, queue=None):
+        if self.tagged:
+            queue = (queue or 'unknown') if self.per_queue else None
+            return TaskKeys._make(
+                tags.tagged(f'celery.{event}', task=task_name, queue=queue) for event in TaskKeys._fields
+            )
+        task = task_name.replace('.', '_')
+        prefix = self.queue_prefixes.get(queue, '')
+        queue = (queue or 'unknown').replace('.', '_')
+        return TaskKeys._make(
+            self.template.format(task=task, event=event, queue=queue, prefix=prefix) for event in TaskKeys._fields
+        )
+
+    def preload(self, task_names, queues=()):
+        """
+        Build the keys of `task_names` for all `queues` up front.
+        """
+        for task_name in task_names:
+            for queue in queues or [None]:
+                self.get(task_name, queue)
+
+
+task_key_registry = TaskKeyRegistry(
+    template=getattr(settings, 'STATSD_CELERY_KEY_TEMPLATE', 'celery.{task}.{event}'),
+    queue_prefixes=getattr(settings, 'STATSD_CELERY_QUEUE_PREFIXES', None),
+    tagged=bool(tags.TAG_FORMAT),
+)
+
+
+def get_task_keys(task, request=None):
+    """
+    Return the `TaskKeys` of `task`, for the queue of `request` (which defaults to the current request of `task`).
+    """
+    queue = None
+    if task_key_registry.per_queue:
+        if request is None:
+            request = getattr(task, 'request', None)
+        delivery_info = getattr(request, 'delivery_info', None) or {}
+        queue = delivery_info.get('routing_key')
+    return task_key_registry.get(task.name, queue)
+
+
+_task_start_times = TaskStartTimes(
+    max_size=getattr(settings, 'STATSD_CELERY_MAX_TRACKED_TASKS', 10000),
+    ttl=getattr(settings, 'STATSD_CELERY_TRACKED_TASK_TTL', 86400),
+)
+
+
+def on_before_task_publish(sender=None, headers=None, routing_key=None, **kwds):
     """
     Handle Celery ``before_task_publish`` signals.
     """
     # Increase statsd counter.
-    statsd.incr('celery.{}.before_task_publish'.format(sender.replace('.', '_')))
+    statsd.incr(task_key_registry.get(sender, routing_key).before_task_publish)
+
+    # Stamp the publish time. (For logging the queue wait in the prerun.)
+    if headers is not None:
+        headers[PUBLISHED_AT_HEADER] = time.time()
 
 
-def on_after_task_publish(sender=None, **kwds):
+def on_after_task_publish(sender=None, routing_key=None, **kwds):
     """
     Handle Celery ``after_task_publish`` signals.
     """
     # Increase statsd counter.
-    statsd.incr('celery.{}.after_task_publish'.format(sender.replace('.', '_')))
+    statsd.incr(task_key_registry.get(sender, routing_key).after_task_publish)
 
 
 def on_task_prerun(sender=None, task_id=None, **kwds):
     """
     Handle Celery ``task_prerun``signals.
     """
+    keys = get_task_keys(sender)
+
     # Increase statsd counter.
-    statsd.incr('celery.{}.start'.format(sender.name.replace('.', '_')))
+    statsd.incr(keys.start)
 
     # Keep track of start times. (For logging the duration in the postrun.)
-    _task_start_times[task_id] = time.time()
+    evicted = _task_start_times.start(task_id, time.perf_counter_ns())
+    if evicted:
+        statsd.incr('celery.tracked_tasks.evicted', evicted)
+    statsd.gauge('celery.tracked_tasks', len(_task_start_times))
+
+    # Log the time spent in the broker queue.
+    published_at = get_published_at(sender)
+    if published_at is not None:
+        statsd.timing(keys.queue_wait, _ms_since(published_at))
 
 
 def on_task_postrun(sender=None, task_id=None, **kwds):
     """
     Handle Celery ``task_postrun`` signals.
     """
+    keys = get_task_keys(sender)
+
     # Increase statsd counter.
-    statsd.incr('celery.{}.done'.format(sender.name.replace('.', '_')))
+    statsd.incr(keys.done)
 
     # Log duration.
-    start_time = _task_start_times.pop(task_id, False)
-    if start_time:
-        ms = int((time.time() - start_time) * 1000)
-        statsd.timing('celery.{}.runtime'.format(sender.name.replace('.', '_')), ms)
+    start_time = _task_start_times.stop(task_id)
+    if start_time is not None:
+        ms = (time.perf_counter_ns() - start_time) / 1e6
+        statsd.timing(keys.runtime, ms)
+
+    # Log the time from publishing until done.
+    published_at = get_published_at(sender)
+    if published_at is not None:
+        statsd.timing(keys.end_to_end, _ms_since(published_at))
 
 
 def on_task_success(sender=None, **kwds):
@@ -51,7 +251,7 @@ def on_task_success(sender=None, **kwds):
     Handle Celery ``task_success`` signals.
     """
     # Increase statsd counter.
-    statsd.incr('celery.{}.success'.format(sender.name.replace('.', '_')))
+    statsd.incr(get_task_keys(sender).success)
 
 
 def on_task_failure(sender=None, task_id=None, task=None, **kwds):
@@ -59,31 +259,33 @@ def on_task_failure(sender=None, task_id=None, task=None, **kwds):
     Handle Celery ``task_failure`` signals.
     """
     # Increase statsd counter.
-    statsd.incr('celery.{}.failure'.format(sender.name.replace('.', '_')))
+    statsd.incr(get_task_keys(sender).failure)
 
 
-def on_task_retry(sender=None, **kwds):
+def on_task_retry(sender=None, request=None, **kwds):
     """
     Handle Celery ``task_retry`` signals.
     """
     # Increase statsd counter.
-    statsd.incr('celery.{}.retry'.format(sender.name.replace('.', '_')))
+    statsd.incr(get_task_keys(sender, request).retry)
 
 
-def on_task_revoked(sender=None, **kwds):
+def on_task_revoked(sender=None, request=None, **kwds):
     """
     Handle Celery ``task_revoked`` signals.
     """
     # Increase statsd counter.
-    statsd.incr('celery.{}.revoked'.format(sender.name.replace('.', '_')))
+    statsd.incr(get_task_keys(sender, request).revoked)
 
 
-def on_task_unknown(sender=None, name=None, **kwds):
+def on_task_unknown(sender=None, name=None, message=None, **kwds):
     """
     Handle Celery ``task_unknown`` signals.
     """
+    delivery_info = getattr(message, 'delivery_info', None) or {}
+
     # Increase statsd counter.
-    statsd.incr('celery.{}.unknown'.format(name.replace('.', '_')))
+    statsd.incr(task_key_registry.get(name, delivery_info.get('routing_key')).unknown)
 
 
 def on_task_rejected(sender=None, **kwds):
@@ -94,6 +296,164 @@ def on_task_rejected(sender=None, **kwds):
     statsd.incr('celery.rejected')
 
 
+def on_worker_init(sender=None, **kwds):
+    """
+    Handle Celery ``worker_init`` signals.
+    """
+    # Build the keys of the registered tasks before the pool processes are forked, so they all share them.
+    app = getattr(sender, 'app', None)
+    if app is not None:
+        queues = list(app.amqp.queues) if task_key_registry.per_queue else ()
+        task_key_registry.preload(list(app.tasks), queues)
+
+
+def _get_queue(request):
+    delivery_info = getattr(request, 'delivery_info', None) or {}
+    return (delivery_info.get('routing_key') or 'unknown').replace('.', '_')
+
+
+def _get_process_index():
+    """
+    Return the index of the current pool process, which a replacement process takes over, or ``main`` outside the pool.
+    """
+    try:
+        from billiard.process import current_process
+    except ImportError:  # pragma: no cover
+        return 'main'
+    index = getattr(current_process(), 'index', None)
+    return 'main' if index is None else index
+
+
+class WorkerStats:
+    """
+    Per-queue and per-worker-process throughput of a Celery worker, kept in-process and sent every `interval` seconds
+    instead of per event.
+
+    Every interval, each worker process sends:
+
+    - ``celery.queue.<queue>.active.<host>.<index>``: the tasks of the queue that this process is executing, as a
+      gauge. Sum them over the hosts and processes for the total of a queue.
+    - ``celery.queue.<queue>.executed``: the tasks executed since the last interval, as a counter.
+    - ``celery.worker.<host>.<index>.active`` and ``celery.worker.<host>.<index>.executed``: the same, for this process.
+
+    The process that consumes from the broker also sends the prefetch occupancy, the tasks it has received that have
+    not started yet, as ``celery.queue.<queue>.prefetched.<host>`` and ``celery.worker.<host>.prefetched`` gauges.
+
+    The gauges are absolute and keyed by the index of the process in the pool, not its pid. A process that replaces a
+    killed or recycled one takes over its index, so it overwrites the gauges the killed process left behind, and the
+    number of keys doesn't grow with every new process. The gauges are set to 0 when a worker shuts down.
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self._thread = None
+        self.reset()
+
+    def reset(self, consumer=False):
+        # A forked pool process inherits the lock as it was, possibly held by the flush thread of the parent, which
+        # doesn't exist in the child to release it.
+        self._lock = threading.Lock()
+        self.consumer = consumer
+        self.hostname = socket.gethostname().replace('.', '_')
+        self.node = f'{self.hostname}.{_get_process_index()}'
+        self._active = Counter()
+        self._executed = Counter()
+        # The queues that got a gauge, so it is set to 0 when they are idle.
+        self._active_queues = set()
+        self._prefetched_queues = set()
+
+    def on_task_prerun(self, sender=None, **kwds):
+        queue = _get_queue(getattr(sender, 'request', None))
+        with self._lock:
+            self._active[queue] += 1
+
+    def on_task_postrun(self, sender=None, **kwds):
+        queue = _get_queue(getattr(sender, 'request', None))
+        with self._lock:
+            self._active[queue] -= 1
+            self._executed[queue] += 1
+
+    def on_worker_init(self, **kwds):
+        # The pool processes are forked after this, so they start with a copy of this state and reset it.
+        self.reset(consumer=True)
+        self.start()
+
+    def on_worker_process_init(self, **kwds):
+        self.reset()
+        self.start()
+
+    def on_worker_shutdown(self, **kwds):
+        # Whatever is still running or prefetched won't be reported on by this process anymore.
+        with self._lock:
+            self._active.clear()
+        self.flush(prefetched=Counter())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._flush_periodically, name='statsd-celery-stats', daemon=True)
+        self._thread.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def get_prefetched(self):
+        from celery.worker import state
+
+        prefetched = Counter()
+        active = set(state.active_requests)
+        for request in list(state.reserved_requests):
+            if request not in active:
+                prefetched[_get_queue(request)] += 1
+        return prefetched
+
+    def flush(self, prefetched=None):
+        with self._lock:
+            active = Counter(self._active)
+            executed, self._executed = self._executed, Counter()
+
+        self._send_gauges('active', active, self._active_queues, self.node)
+        for queue, count in executed.items():
+            statsd.incr(self._queue_key(queue, 'executed'), count)
+        statsd.gauge(self._worker_key(self.node, 'active'), sum(active.values()))
+        if executed:
+            statsd.incr(self._worker_key(self.node, 'executed'), sum(executed.values()))
+
+        if self.consumer:
+            if prefetched is None:
+                prefetched = self.get_prefetched()
+            self._send_gauges('prefetched', prefetched, self._prefetched_queues, self.hostname)
+            statsd.gauge(self._worker_key(self.hostname, 'prefetched'), sum(prefetched.values()))
+
+    def _send_gauges(self, name, current, queues, worker):
+        queues.update(current)
+        for queue in queues:
+            statsd.gauge(self._queue_key(queue, name, worker), current[queue])
+
+    def _queue_key(self, queue, name, worker=None):
+        if tags.TAG_FORMAT:
+            return tags.tagged(f'celery.queue.{name}', queue=queue, worker=worker)
+        if worker is None:
+            return f'celery.queue.{queue}.{name}'
+        return f'celery.queue.{queue}.{name}.{worker}'
+
+    def _worker_key(self, worker, name):
+        if tags.TAG_FORMAT:
+            return tags.tagged(f'celery.worker.{name}', worker=worker)
+        return f'celery.worker.{worker}.{name}'
+
+    def connect(self, signals):
+        signals.task_prerun.connect(self.on_task_prerun)
+        signals.task_postrun.connect(self.on_task_postrun)
+        signals.worker_init.connect(self.on_worker_init)
+        signals.worker_process_init.connect(self.on_worker_process_init)
+        signals.worker_shutdown.connect(self.on_worker_shutdown)
+        signals.worker_process_shutdown.connect(self.on_worker_shutdown)
+
+
+worker_stats = WorkerStats(interval=getattr(settings, 'STATSD_CELERY_WORKER_STATS_INTERVAL', 10))
+
+
 def register_celery_events():
     try:
         from celery import signals
@@ -112,3 +472,6 @@ def register_celery_events():
         signals.task_revoked.connect(on_task_revoked)
         signals.task_unknown.connect(on_task_unknown)
         signals.task_rejected.connect(on_task_rejected)
+        signals.worker_init.connect(on_worker_init)
+        if getattr(settings, 'STATSD_CELERY_WORKER_STATS', False):
+            worker_stats.connect(signals)
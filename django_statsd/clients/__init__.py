@@ -1,31 +1,266 @@
-from datetime import datetime, timedelta
+import asyncio
+import atexit
+import threading
 from importlib import import_module
+from time import monotonic
 
 from django.conf import settings
+from django.core.signals import setting_changed
+
+from django_statsd import tags
+from django_statsd.aggregation import get_aggregator
+from django_statsd.histogram import Histograms, histogram_methods
+from django_statsd.resolver import HostResolver
+from django_statsd.sampling import AdaptiveSampleRates, SampleRates, sampled_methods
+
+# Settings that are used to build the client. Changing any of them (e.g. with ``override_settings``) drops the cached
+# client, so the next metric is sent with a client that matches the new configuration.
+CLIENT_SETTINGS = frozenset(
+    [
+        'STATSD_CLIENT',
+        'STATSD_HOST',
+        'STATSD_PORT',
+        'STATSD_PREFIX',
+        'STATSD_CLIENT_OPTIONS',
+        'STATSD_REFRESH_SECONDS',
+        'STATSD_BACKGROUND_RESOLVE',
+        'STATSD_SAMPLE_RATES',
+        'STATSD_SAMPLE_BUDGET',
+        'STATSD_HISTOGRAMS',
+        'STATSD_HISTOGRAM_INTERVAL',
+    ]
+)
+
+# The client methods that are used for sending metrics. These are bound once per client and looked up from a dict
+# afterwards, instead of being fetched from the client on every call.
+HOT_METHODS = frozenset(['incr', 'decr', 'timing', 'timer', 'gauge', 'set'])
+
+
+def close_client(client):
+    """
+    Close the socket of a client that is no longer used.
+    """
+    close = getattr(client, 'close', None)
+    if close is not None:
+        close()
+        return
+    sock = getattr(client, '_sock', None)
+    if sock is not None:
+        sock.close()
+
+
+def on_event_loop():
+    """
+    Return whether the current thread is running an event loop.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def get_config():
+    """
+    Read the client configuration from the Django settings.
+    """
+    return {
+        'client': getattr(settings, 'STATSD_CLIENT', 'statsd.client'),
+        'host': getattr(settings, 'STATSD_HOST', 'localhost'),
+        'port': getattr(settings, 'STATSD_PORT', 8125),
+        'prefix': getattr(settings, 'STATSD_PREFIX', None),
+        'options': getattr(settings, 'STATSD_CLIENT_OPTIONS', {}),
+        'refresh_seconds': getattr(settings, 'STATSD_REFRESH_SECONDS', 120),
+        'background_resolve': getattr(settings, 'STATSD_BACKGROUND_RESOLVE', False),
+        'sample_rates': getattr(settings, 'STATSD_SAMPLE_RATES', {}),
+        'sample_budget': getattr(settings, 'STATSD_SAMPLE_BUDGET', None),
+        'histograms': getattr(settings, 'STATSD_HISTOGRAMS', {}),
+        'histogram_interval': getattr(settings, 'STATSD_HISTOGRAM_INTERVAL', 10),
+    }
 
 
 class StatsdClientProxy:
     """
     A proxy class for the actual StatsdClient. This will instantiate a new client every 2 minutes, so that if the statsd
     host changes IP, we'll do a DNS lookup to discover it instead of sending the UDP packets into the void.
+
+    The settings are only read when a client is built and are cached until one of them changes, and the refresh
+    deadline is kept as a monotonic timestamp, so a metric only costs a clock read and a dict lookup on top of the call
+    to the client.
+
+    When the deadline passes, exactly one thread builds the new client while the other threads keep sending through the
+    old one. A replaced client is retired and its socket is closed at the next refresh, when no thread can be using it
+    anymore, so at most two sockets are open per proxy. Building a client looks up the host and closing one can wait
+    for its thread, so on an event loop, the new client is built in a separate thread and the loop keeps sending
+    through the old one meanwhile.
+
+    With ``STATSD_BACKGROUND_RESOLVE`` the client is kept for good instead, and a ``HostResolver`` thread updates its
+    address every ``STATSD_REFRESH_SECONDS``.
+
+    With ``STATSD_SAMPLE_RATES``, the metrics that are sent without a rate get the rate of their key. With
+    ``STATSD_SAMPLE_BUDGET``, the rates are lowered further when a key family is sent more often than that per second.
+
+    The ``histogram`` method counts values into buckets, which are sent every ``STATSD_HISTOGRAM_INTERVAL`` seconds.
+    The timings of the keys in ``STATSD_HISTOGRAMS`` are counted into buckets as well, instead of being sent. When the
+    interpreter exits, the histograms are sent and then the client is closed.
+
+    Tagged keys (``<name>;<tag>=<value>``) are sent as they are, which is the Graphite format, or with
+    ``STATSD_TAG_FORMAT = 'dogstatsd'``, with the tags after the value (``|#<tag>:<value>``).
+
+    While a ``RequestAggregator`` is active in the current context, the metrics it aggregates are sent to it instead.
     """
 
-    _client = None
+    _own_attributes = frozenset(
+        [
+            '_client',
+            '_config',
+            '_methods',
+            '_expires_at',
+            '_lock',
+            '_retired',
+            '_resolver',
+            '_sample_rates',
+            '_histograms',
+            'flush',
+            '_refresh',
+            '_rebuild',
+            '_rebuild_and_release',
+            '_setting_changed',
+            '_exit',
+        ]
+    )
+
+    def __init__(self):
+        self._client = None
+        self._config = None
+        self._methods = {}
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._retired = None
+        self._resolver = None
+        self._sample_rates = None
+        self._histograms = None
+        setting_changed.connect(self._setting_changed)
 
     def __getattribute__(self, name):
-        if name == '_client':
+        if name in StatsdClientProxy._own_attributes:
             return super().__getattribute__(name)
 
-        refresh_cutoff = datetime.now() - timedelta(seconds=getattr(settings, 'STATSD_REFRESH_SECONDS', 120))
-        if self._client is None or not hasattr(self._client, 'created_at') or self._client.created_at < refresh_cutoff:
-            client = getattr(settings, 'STATSD_CLIENT', 'statsd.client')
-            host = getattr(settings, 'STATSD_HOST', 'localhost')
-            port = getattr(settings, 'STATSD_PORT', 8125)
-            prefix = getattr(settings, 'STATSD_PREFIX', None)
-            self._client = import_module(client).StatsClient(host=host, port=port, prefix=prefix)
-            self._client.created_at = datetime.now()
+        state = super().__getattribute__('__dict__')
+        if monotonic() >= state['_expires_at']:
+            self._refresh()
+
+        aggregator = get_aggregator()
+        if aggregator is not None and name in aggregator.methods:
+            return aggregator.methods[name]
+
+        try:
+            return state['_methods'][name]
+        except KeyError:
+            return getattr(state['_client'], name)
+
+    def flush(self):
+        """
+        Send the metrics that are buffered by the client, if it buffers them.
+        """
+        flush = getattr(self._client, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def _refresh(self):
+        if self._client is None:
+            # There is nothing to fall back on yet, so wait for the thread that builds the first client.
+            with self._lock:
+                if self._client is None:
+                    self._rebuild()
+            return
+
+        if not self._lock.acquire(blocking=False):
+            # Another thread is already building the new client.
+            return
+        if on_event_loop():
+            # The thread releases the lock when the new client is in place.
+            threading.Thread(target=self._rebuild_and_release, name='statsd-refresh', daemon=True).start()
+            return
+        self._rebuild_and_release()
+
+    def _rebuild_and_release(self):
+        try:
+            if monotonic() >= self._expires_at:
+                self._rebuild()
+        finally:
+            self._lock.release()
+
+    def _rebuild(self):
+        if self._config is None:
+            self._config = get_config()
+            if self._config['sample_budget']:
+                self._sample_rates = AdaptiveSampleRates(
+                    self._config['sample_rates'], budget=self._config['sample_budget']
+                )
+            else:
+                self._sample_rates = SampleRates(self._config['sample_rates'])
+            if self._histograms is not None:
+                # Send what the old histograms have collected, through the old client.
+                self._histograms.stop()
+                self._histograms.flush()
+            self._histograms = Histograms(self._config['histograms'], interval=self._config['histogram_interval'])
+        config = self._config
+
+        client = import_module(config['client']).StatsClient(
+            host=config['host'], port=config['port'], prefix=config['prefix'], **config['options']
+        )
+        if tags.TAG_FORMAT == 'dogstatsd' and hasattr(client, '_prepare'):
+            # The keys are built with the tag format of startup, so the wire format follows it instead of the settings.
+            client._prepare = tags.dogstatsd_prepare(client._prepare)
+            client.pipeline = tags.dogstatsd_pipeline(client.pipeline)
+        retired, self._retired = self._retired, self._client
+        methods = {name: getattr(client, name) for name in HOT_METHODS if hasattr(client, name)}
+        if self._sample_rates:
+            methods = sampled_methods(methods, self._sample_rates)
+        if isinstance(self._sample_rates, AdaptiveSampleRates):
+            # The rates are reported through the new client, unsampled.
+            self._sample_rates.report = getattr(client, 'gauge', None)
+        # The histograms are sent through the new client, unsampled. Their timings are never sampled either.
+        methods = histogram_methods(methods, self._histograms)
+        self._histograms.client = client
+        self._methods = methods
+        self._client = client
+
+        if self._resolver is not None:
+            self._resolver.stop()
+            self._resolver = None
+        if config['background_resolve'] and hasattr(client, '_addr'):
+            self._resolver = HostResolver(
+                client, config['host'], config['port'], config['refresh_seconds'], family=client._sock.family
+            )
+            self._resolver.start()
+            self._expires_at = float('inf')
+        else:
+            self._expires_at = monotonic() + config['refresh_seconds']
+
+        if retired is not None:
+            close_client(retired)
+
+        # The exit hooks run last in, first out. Registering this one again after the client has registered its own
+        # makes it run first, so the histograms are flushed into the client before it is closed.
+        atexit.unregister(self._exit)
+        atexit.register(self._exit)
+
+    def _exit(self):
+        """
+        Send what the histograms have collected, then send what the client buffers and close it.
+        """
+        if self._histograms is not None:
+            self._histograms.stop()
+            self._histograms.flush()
+        if self._client is not None:
+            close_client(self._client)
 
-        return self._client.__getattribute__(name)
+    def _setting_changed(self, setting, **kwargs):
+        if setting in CLIENT_SETTINGS:
+            self._config = None
+            self._expires_at = 0.0
 
 
 statsd = StatsdClientProxy()
@@ -0,0 +1,54 @@
+import asyncio
+from weakref import WeakKeyDictionary
+
+from statsd.client import StatsClient
+
+
+class StatsClient(StatsClient):
+    """
+    A client for ASGI deployments. When called from a running event loop, the metrics are sent through a datagram
+    transport of that loop, which never blocks the loop. Outside of an event loop, or while the transport of a loop is
+    still being set up, the metrics are sent over the socket like the normal client does.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix=None, maxudpsize=512, ipv6=False):
+        super().__init__(host=host, port=port, prefix=prefix, maxudpsize=maxudpsize, ipv6=ipv6)
+        self._transports = WeakKeyDictionary()
+        self._connecting = set()
+
+    def _send(self, data):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return super()._send(data)
+
+        transport = self._transports.get(loop)
+        if transport is None:
+            if loop not in self._transports:
+                self._transports[loop] = None
+                task = loop.create_task(self._connect(loop))
+                self._connecting.add(task)
+                task.add_done_callback(self._connecting.discard)
+            return super()._send(data)
+
+        transport.sendto(data.encode('ascii'), self._addr)
+
+    async def _connect(self, loop):
+        try:
+            transport, protocol = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, family=self._sock.family
+            )
+        except OSError:
+            # Try again with the next metric.
+            del self._transports[loop]
+        else:
+            self._transports[loop] = transport
+
+    def close(self):
+        """Close the transports and the socket."""
+        for loop, transport in list(self._transports.items()):
+            if transport is not None and not loop.is_closed():
+                # Transports are not thread safe, close it from its own loop.
+                loop.call_soon_threadsafe(transport.close)
+        self._transports.clear()
+        self._sock.close()
@@ -0,0 +1,63 @@
+import atexit
+import threading
+
+from statsd.client import StatsClient
+
+
+class StatsClient(StatsClient):
+    """
+    A client that buffers the metrics and sends them newline separated, packing as many as fit in `maxudpsize` bytes
+    into a single UDP packet.
+
+    The buffer is sent when the next metric would not fit anymore, when `flush` is called (the request timing middleware
+    does so at the end of every request) and every `flush_interval` seconds from a daemon thread. The daemon thread
+    doesn't outlive the interpreter, so the client is closed, and what is left is sent, when the interpreter exits.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix=None, maxudpsize=512, ipv6=False, flush_interval=1.0):
+        super().__init__(host=host, port=port, prefix=prefix, maxudpsize=maxudpsize, ipv6=ipv6)
+        self._lock = threading.Lock()
+        self._lines = []
+        self._size = 0
+        self._stopped = threading.Event()
+        if flush_interval:
+            self._flush_interval = flush_interval
+            threading.Thread(target=self._flush_periodically, name='statsd-flush', daemon=True).start()
+        atexit.register(self.close)
+
+    def _after(self, data):
+        if not data:
+            return
+
+        packet = None
+        with self._lock:
+            if self._lines and self._size + 1 + len(data) > self._maxudpsize:
+                packet = '\n'.join(self._lines)
+                self._lines = []
+                self._size = 0
+            self._size += len(data) + (1 if self._lines else 0)
+            self._lines.append(data)
+
+        if packet is not None:
+            self._send(packet)
+
+    def flush(self):
+        """Send the buffered metrics."""
+        with self._lock:
+            lines = self._lines
+            self._lines = []
+            self._size = 0
+
+        if lines:
+            self._send('\n'.join(lines))
+
+    def close(self):
+        """Send the buffered metrics and close the socket."""
+        atexit.unregister(self.close)
+        self._stopped.set()
+        self.flush()
+        self._sock.close()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self._flush_interval):
+            self.flush()
@@ -0,0 +1,108 @@
+import atexit
+import threading
+from collections import deque
+
+from django_statsd.clients import on_event_loop
+from django_statsd.clients.batch import StatsClient
+
+DROP_POLICIES = ('drop-newest', 'drop-oldest')
+
+
+class StatsClient(StatsClient):
+    """
+    A client that never sends from the calling thread. Metrics are put on a bounded queue that is drained by a daemon
+    thread every `flush_interval` seconds, which packs them into packets like the batch client does.
+
+    When the queue holds `queue_size` metrics, `drop_policy` decides whether the new metric (``drop-newest``) or the
+    oldest queued one (``drop-oldest``) is dropped. Dropped metrics are counted in `dropped` and reported as
+    ``statsd.queue.dropped``. The queue is drained one last time when the client is closed or the interpreter exits.
+    """
+
+    def __init__(
+        self,
+        host='localhost',
+        port=8125,
+        prefix=None,
+        maxudpsize=512,
+        ipv6=False,
+        flush_interval=0.1,
+        queue_size=10000,
+        drop_policy='drop-newest',
+    ):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError('drop_policy must be one of: {}'.format(', '.join(DROP_POLICIES)))
+        if not flush_interval:
+            raise ValueError('The threaded client needs a flush_interval')
+
+        self._queue = deque(maxlen=queue_size if drop_policy == 'drop-oldest' else None)
+        self._queue_size = queue_size
+        self._drop_newest = drop_policy == 'drop-newest'
+        self._wakeup = threading.Event()
+        self._close_when_stopped = False
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._reported_dropped = 0
+        super().__init__(host=host, port=port, prefix=prefix, maxudpsize=maxudpsize, ipv6=ipv6, flush_interval=0)
+
+        self._flush_interval = flush_interval
+        self._thread = threading.Thread(target=self._flush_periodically, name='statsd-sender', daemon=True)
+        self._thread.start()
+
+    def _after(self, data):
+        if not data:
+            return
+        queue = self._queue
+        if len(queue) >= self._queue_size:
+            # The queue is full when many threads are sending, so the count needs a lock not to lose drops.
+            with self._dropped_lock:
+                self.dropped += 1
+            if self._drop_newest:
+                return
+        # A deque append is atomic, so the calling threads don't need a lock.
+        queue.append(data)
+
+    def flush(self):
+        """Wake up the sender thread, the metrics are sent from there."""
+        self._wakeup.set()
+
+    def close(self):
+        """Stop the sender thread, send what is still queued and close the socket."""
+        atexit.unregister(self.close)
+        if self._thread is not threading.current_thread() and on_event_loop():
+            # Don't block the loop on the sender thread, it sends what is left and closes the socket itself.
+            self._close_when_stopped = True
+            self._stopped.set()
+            self._wakeup.set()
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._drain()
+        self._sock.close()
+
+    def _flush_periodically(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self._drain()
+        if self._close_when_stopped:
+            self._drain()
+            self._sock.close()
+
+    def _drain(self):
+        pack = super()._after
+        dropped = self.dropped - self._reported_dropped
+        if dropped:
+            # Bypass the queue, which is probably still full.
+            self._reported_dropped += dropped
+            pack(self._prepare('statsd.queue.dropped', f'{dropped}|c', 1))
+
+        pop = self._queue.popleft
+        while True:
+            try:
+                data = pop()
+            except IndexError:
+                break
+            pack(data)
+        super().flush()
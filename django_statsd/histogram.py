@@ -0,0 +1,238 @@
+import os
+import re
+import threading
+import weakref
+from bisect import bisect_left
+from fnmatch import translate
+
+from statsd.client import Timer
+
+from django_statsd.tags import suffixed
+
+# The lookups of the buckets are cached per key, see ``sampling.RATE_CACHE_SIZE``.
+BUCKET_CACHE_SIZE = 10000
+
+
+def linear_buckets(start, width, count):
+    """
+    Return `count` bucket boundaries, `width` apart, from `start`.
+    """
+    return tuple(start + width * i for i in range(count))
+
+
+def log_linear_buckets(lowest=1, highest=60000, steps=9):
+    """
+    Return the bucket boundaries from `lowest` up to `highest`: every power of 10 is split into `steps` buckets of the
+    same width, so the buckets grow with the values and the relative error stays the same, like an HDR histogram.
+
+    With the defaults, the boundaries are 1, 2, ..., 9, 10, 20, ..., 90, 100, 200, ... up to 60000.
+    """
+    bounds = []
+    magnitude = lowest
+    while True:
+        for i in range(steps):
+            # Rounded, so the boundaries are short on the wire.
+            bound = float(f'{magnitude * (1 + 9 * i / steps):.6g}')
+            bounds.append(int(bound) if bound.is_integer() else bound)
+            if bound >= highest:
+                return tuple(bounds)
+        magnitude *= 10
+
+
+# Milliseconds, from 1 up to a minute.
+DEFAULT_BUCKETS = log_linear_buckets()
+
+
+def get_buckets(spec):
+    """
+    Return the bucket boundaries of a configured `spec`, see `Histograms`.
+    """
+    if spec is None:
+        return DEFAULT_BUCKETS
+    if isinstance(spec, dict):
+        return log_linear_buckets(**spec)
+    return tuple(sorted(spec))
+
+
+class Histogram:
+    """
+    The number of values of a key per bucket. A value falls into the first bucket whose boundary is at least the value,
+    or into the last bucket (``inf``) when it is larger than all boundaries.
+    """
+
+    __slots__ = ('stat', 'bounds', 'keys', 'counts', 'count', 'sum')
+
+    def __init__(self, stat, bounds):
+        self.stat = stat
+        self.bounds = bounds
+        labels = [str(bound).replace('.', '_') for bound in bounds] + ['inf']
+        self.keys = [suffixed(stat, f'bucket.{label}') for label in labels]
+        self.counts = [0] * len(self.keys)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Histograms:
+    """
+    Pre-aggregates values into histograms, so statsd receives the number of values per bucket instead of every value.
+
+    The buckets of a key are configured as a dict of shell-style patterns (e.g. ``{'view.*': None}``), the most
+    specific (longest) matching pattern wins. The buckets are a sequence of boundaries, the arguments of
+    `log_linear_buckets` as a dict, or None for the default ones.
+
+    Every `interval` seconds, a daemon thread sends the histograms that got values through `client` as counters:
+    ``<key>.bucket.<boundary>`` for every bucket that got values, ``<key>.count`` and ``<key>.sum``. These counters add
+    up across processes, so the percentiles can be derived from the buckets of all of them. The cost of a key is the
+    number of its buckets per interval, whatever the number of values, and adding a value only counts it.
+
+    The thread is started with the first histogram. A forked process starts with empty histograms and its own thread,
+    so the values of the parent aren't sent twice.
+    """
+
+    def __init__(self, buckets=None, interval=10.0, client=None):
+        patterns = sorted((buckets or {}).items(), key=lambda item: len(item[0]), reverse=True)
+        self.patterns = [(re.compile(translate(pattern)).match, get_buckets(bounds)) for pattern, bounds in patterns]
+        self.interval = interval
+        self.client = client
+        self.histograms = {}
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        _instances.add(self)
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def get(self, stat):
+        """
+        Return the configured buckets of `stat`, or None when it isn't aggregated.
+        """
+        try:
+            return self._cache[stat]
+        except KeyError:
+            pass
+
+        bounds = None
+        for match, pattern_bounds in self.patterns:
+            if match(stat):
+                bounds = pattern_bounds
+                break
+        if len(self._cache) >= BUCKET_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[stat] = bounds
+        return bounds
+
+    def add(self, stat, value, rate=1):
+        """
+        Add `value` to the histogram of `stat`, with the default buckets when it has no configured ones. Every value is
+        counted, so `rate` is ignored.
+        """
+        with self._lock:
+            try:
+                histogram = self.histograms[stat]
+            except KeyError:
+                histogram = self.histograms[stat] = Histogram(stat, self.get(stat) or DEFAULT_BUCKETS)
+                if self._thread is None:
+                    self.start()
+            histogram.add(value)
+
+    # Lets ``Timer`` send to the histograms.
+    timing = add
+
+    def timer(self, stat, rate=1):
+        return Timer(self, stat, rate)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._flush_periodically, name='statsd-histograms', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def _after_fork(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def flush(self):
+        """
+        Send the histograms that got values since the last flush through the client.
+        """
+        with self._lock:
+            histograms, self.histograms = self.histograms, {}
+            sent = []
+            for stat, histogram in histograms.items():
+                if histogram.count:
+                    sent.append((stat, histogram.keys, histogram.counts, histogram.count, histogram.sum))
+                    # The histogram is kept while the key is in use, so its keys are only built once.
+                    histogram.counts = [0] * len(histogram.keys)
+                    histogram.count = 0
+                    histogram.sum = 0.0
+                    self.histograms[stat] = histogram
+
+        client = self.client
+        if client is None:
+            return
+        for stat, keys, counts, count, total in sent:
+            for key, bucket_count in zip(keys, counts):
+                if bucket_count:
+                    client.incr(key, bucket_count)
+            client.incr(suffixed(stat, 'count'), count)
+            client.incr(suffixed(stat, 'sum'), round(total, 3))
+
+
+# The threads don't survive a fork, and the child must not send what the parent has collected.
+_instances = weakref.WeakSet()
+
+
+def _after_fork():
+    for histograms in list(_instances):
+        histograms._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def histogram_methods(methods, histograms):
+    """
+    Add the ``histogram`` and ``distribution`` methods to the `methods` of a client, and wrap its ``timing`` and
+    ``timer`` methods, so the timings of the keys that have buckets go into their histograms.
+    """
+    methods = dict(methods)
+    methods['histogram'] = methods['distribution'] = histograms.add
+    if not histograms:
+        return methods
+    get_bounds = histograms.get
+    add = histograms.add
+
+    if 'timing' in methods:
+        timing = methods['timing']
+
+        def histogram_timing(stat, delta, *args):
+            if get_bounds(stat) is None:
+                return timing(stat, delta, *args)
+            return add(stat, delta)
+
+        methods['timing'] = histogram_timing
+
+    if 'timer' in methods:
+        timer = methods['timer']
+
+        def histogram_timer(stat, *args):
+            if get_bounds(stat) is None:
+                return timer(stat, *args)
+            return histograms.timer(stat)
+
+        methods['timer'] = histogram_timer
+
+    return methods
@@ -1,5 +1,6 @@
 import logging
 
+from django_statsd import tags
 from django_statsd.clients import statsd
 
 
@@ -10,4 +11,8 @@ class StatsdHandler(logging.Handler):
         if not record.exc_info:
             return
 
-        statsd.incr(f'error.{record.exc_info[0].__name__.lower()}')
+        error = record.exc_info[0].__name__.lower()
+        if tags.TAG_FORMAT:
+            statsd.incr(tags.tagged('error', type=error))
+        else:
+            statsd.incr(f'error.{error}')
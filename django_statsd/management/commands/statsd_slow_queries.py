@@ -0,0 +1,44 @@
+import argparse
+from datetime import datetime
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from django_statsd.patches import db
+
+
+class Command(BaseCommand):
+    help = """
+    Show the slow database queries of this process, optionally after running
+    another management command, for example:
+
+        statsd_slow_queries --threshold 100 migrate
+
+    The queries are only recorded by the database patches in STATSD_PATCHES.
+    The slow queries of a web process are shown in its toolbar panel.
+
+    `threshold`: the milliseconds a query has to take to be slow, defaults to
+    STATSD_DB_SLOW_QUERY_MS
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threshold', action='store', type=float, dest='threshold', help='Slow query threshold')
+        parser.add_argument('command', nargs=argparse.REMAINDER, help='Command to run, with its arguments')
+
+    def handle(self, *args, **kw):
+        command = kw.get('command')
+        if command:
+            threshold = db.SLOW_QUERY_MS
+            if kw.get('threshold') is not None:
+                db.SLOW_QUERY_MS = kw['threshold']
+            try:
+                call_command(*command)
+            finally:
+                db.SLOW_QUERY_MS = threshold
+
+        for query in list(db.slow_queries):
+            self.stdout.write(
+                '{} {} {:.1f}ms {}'.format(
+                    datetime.fromtimestamp(query.time).isoformat(' ', 'seconds'), query.alias, query.ms, query.sql
+                )
+            )
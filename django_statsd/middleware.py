@@ -1,12 +1,17 @@
 import inspect
 import time
+from collections import namedtuple
+from functools import lru_cache
 
+from asgiref.sync import iscoroutinefunction, sync_to_async
 from django import VERSION as DJANGO_VERSION
 from django.conf import settings
 from django.core.exceptions import BadRequest, PermissionDenied, SuspiciousOperation
 from django.http import Http404
 from django.http.multipartparser import MultiPartParserError
+from django.utils.functional import SimpleLazyObject, empty
 
+from django_statsd import aggregation, tags
 from django_statsd.clients import statsd
 
 try:
@@ -21,11 +26,93 @@ def is_authenticated(user):  # pragma: no cover
     return user.is_authenticated
 
 
-class GraphiteMiddleware(MiddlewareMixin):
+# The timing keys of a view: ``view.<module>.<name>.<method>``, ``view.<module>.<method>`` and ``view.<method>``, and
+# the keys of its database stats. With a tag format, a view is only timed as ``view`` with the module, name and method
+# as tags, and `module_method` and `method` are None.
+ViewKeys = namedtuple('ViewKeys', ['module', 'name', 'view', 'module_method', 'method', 'db_queries', 'db_time'])
+
+VIEW_KEY_CACHE_SIZE = getattr(settings, 'STATSD_VIEW_KEY_CACHE_SIZE', 1024)
+
+
+@lru_cache(maxsize=VIEW_KEY_CACHE_SIZE)
+def named_view_keys(module, name, method):
+    if tags.TAG_FORMAT:
+        return ViewKeys(
+            module,
+            name,
+            tags.tagged('view', module=module, name=name, method=method),
+            None,
+            None,
+            tags.tagged('view.db_queries', module=module, name=name),
+            tags.tagged('view.db_time', module=module, name=name),
+        )
+    return ViewKeys(
+        module,
+        name,
+        f'view.{module}.{name}.{method}',
+        f'view.{module}.{method}',
+        f'view.{method}',
+        f'view.{module}.{name}.db_queries',
+        f'view.{module}.{name}.db_time',
+    )
+
+
+def build_view_keys(view_func, method):
+    view = view_func
+    if not inspect.isfunction(view_func):
+        view = view.__class__
+    return named_view_keys(view.__module__, view.__name__, method)
+
+
+# There is only a small set of views and methods, so the keys are built once per combination. The hits and misses can
+# be checked with ``view_keys.cache_info()``.
+view_keys = lru_cache(maxsize=VIEW_KEY_CACHE_SIZE)(build_view_keys)
+
+
+class StatsdMiddlewareMixin(MiddlewareMixin):
+    """
+    A MiddlewareMixin for middleware whose hooks only record metrics and never block.
+
+    Under ASGI, Django's MiddlewareMixin runs ``process_request``, ``process_view`` and ``process_response`` in a
+    thread through ``sync_to_async``. These hooks are cheap enough to run on the event loop directly, which saves a
+    thread hop per hook and request.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if iscoroutinefunction(self) and hasattr(self, 'process_view'):
+            # Django adapts sync view hooks with sync_to_async, so hand it a coroutine function instead.
+            process_view = self.process_view
+
+            async def aprocess_view(request, view_func, view_args, view_kwargs):
+                return process_view(request, view_func, view_args, view_kwargs)
+
+            self.process_view = aprocess_view
+
+    async def __acall__(self, request):
+        response = None
+        if hasattr(self, 'process_request'):
+            response = self.process_request(request)
+        response = response or await self.get_response(request)
+        if hasattr(self, 'process_response'):
+            response = self.process_response(request, response)
+        return response
+
+
+class GraphiteMiddleware(StatsdMiddlewareMixin):
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        user = getattr(request, 'user', None)
+        if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+            # The view didn't need the user, loading it hits the database and that can't happen on the event loop.
+            await sync_to_async(user._setup, thread_sensitive=True)()
+        return self.process_response(request, response)
+
     def process_response(self, request, response):
-        statsd.incr(f'response.{response.status_code}')
-        if hasattr(request, 'user') and request.user and is_authenticated(request.user):
-            statsd.incr(f'response.auth.{response.status_code}')
+        self._count(request, response.status_code)
         return response
 
     def process_exception(self, request, exception):
@@ -36,38 +123,82 @@ class GraphiteMiddleware(MiddlewareMixin):
             exception,
             Http404 | PermissionDenied | MultiPartParserError | BadRequest | SuspiciousOperation,
         ):
-            statsd.incr('response.500')
-            if hasattr(request, 'user') and request.user and is_authenticated(request.user):
-                statsd.incr('response.auth.500')
+            self._count(request, 500)
 
+    def _count(self, request, status_code):
+        authenticated = hasattr(request, 'user') and request.user and is_authenticated(request.user)
+        if tags.TAG_FORMAT:
+            statsd.incr(tags.tagged('response', status=status_code, auth='true' if authenticated else 'false'))
+            return
+        statsd.incr(f'response.{status_code}')
+        if authenticated:
+            statsd.incr(f'response.auth.{status_code}')
 
-class GraphiteRequestTimingMiddleware(MiddlewareMixin):
+
+class GraphiteRequestTimingMiddleware(StatsdMiddlewareMixin):
     """statsd's timing data per view."""
 
+    def process_request(self, request):
+        if getattr(settings, 'STATSD_AGGREGATE', False):
+            timers = getattr(settings, 'STATSD_AGGREGATE_TIMERS', False)
+            request._statsd_aggregator = aggregation.activate(timers=timers)
+        if getattr(settings, 'STATSD_DB_REQUEST_STATS', False):
+            request._statsd_queries = aggregation.count_queries()
+        request._statsd_cache_hits = aggregation.count_cache_hits()
+
     def process_view(self, request, view_func, view_args, view_kwargs):
-        view = view_func
-        if not inspect.isfunction(view_func):
-            view = view.__class__
+        try:
+            keys = view_keys(view_func, request.method)
+        except TypeError:
+            # The view is an unhashable callable.
+            keys = build_view_keys(view_func, request.method)
 
-        request._view_module = view.__module__
-        request._view_name = view.__name__
-        request._start_time = time.time()
+        request._view_module = keys.module
+        request._view_name = keys.name
+        request._view_keys = keys
+        request._start_time = time.perf_counter_ns()
 
     def process_response(self, request, response):
+        queries = getattr(request, '_statsd_queries', None)
+        if queries is not None:
+            aggregation.stop_counting_queries()
+        cache_hits = getattr(request, '_statsd_cache_hits', None)
+        if cache_hits is not None:
+            aggregation.stop_counting_cache_hits()
+        aggregator = getattr(request, '_statsd_aggregator', None)
+        if aggregator is not None:
+            aggregation.deactivate()
+            aggregator.flush(statsd)
+        if cache_hits is not None:
+            cache_hits.flush(statsd)
+        if queries is not None:
+            self._record_queries(request, queries)
         self._record_time(request)
+        # Send out what a buffering client has collected during this request.
+        statsd.flush()
         return response
 
     def process_exception(self, request, exception):
         self._record_time(request)
 
+    def _record_queries(self, request, queries):
+        keys = getattr(request, '_view_keys', None)
+        if keys is not None:
+            # The query count is sent as a timing, for its percentiles per request.
+            statsd.timing(keys.db_queries, queries.count)
+            statsd.timing(keys.db_time, queries.time)
+            for query_type, count in queries.types.items():
+                statsd.incr(tags.suffixed(keys.db_queries, query_type), count)
+
     def _record_time(self, request):
         if hasattr(request, '_start_time'):
-            ms = int((time.time() - request._start_time) * 1000)
-            data = dict(module=request._view_module, name=request._view_name, method=request.method)
-            statsd.timing('view.{module}.{name}.{method}'.format(**data), ms)
-            if getattr(settings, 'STATSD_VIEW_TIMER_DETAILS', True):
-                statsd.timing('view.{module}.{method}'.format(**data), ms)
-                statsd.timing('view.{method}'.format(**data), ms)
+            # A monotonic clock, so NTP adjustments don't show up, with enough precision for sub-millisecond views.
+            ms = (time.perf_counter_ns() - request._start_time) / 1e6
+            keys = request._view_keys
+            statsd.timing(keys.view, ms)
+            if keys.module_method is not None and getattr(settings, 'STATSD_VIEW_TIMER_DETAILS', True):
+                statsd.timing(keys.module_method, ms)
+                statsd.timing(keys.method, ms)
 
 
 class TastyPieRequestTimingMiddleware(GraphiteRequestTimingMiddleware):
@@ -75,8 +206,10 @@ class TastyPieRequestTimingMiddleware(GraphiteRequestTimingMiddleware):
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         try:
-            request._view_module = view_kwargs['api_name']
-            request._view_name = view_kwargs['resource_name']
-            request._start_time = time.time()
+            keys = named_view_keys(view_kwargs['api_name'], view_kwargs['resource_name'], request.method)
+            request._view_module = keys.module
+            request._view_name = keys.name
+            request._view_keys = keys
+            request._start_time = time.perf_counter_ns()
         except (AttributeError, KeyError):
             super().process_view(request, view_func, view_args, view_kwargs)
@@ -2,6 +2,7 @@ from django.conf import settings
 from django.contrib.auth.signals import user_logged_in, user_logged_out, user_login_failed
 from django.db.models.signals import post_delete, post_save
 
+from django_statsd import tags
 from django_statsd.clients import statsd
 
 from .celery_hooks import register_celery_events
@@ -10,6 +11,12 @@ if getattr(settings, 'STATSD_CELERY_SIGNALS', False):  # pragma: no cover
     register_celery_events()
 
 
+def model_key(instance, action):
+    if tags.TAG_FORMAT:
+        return tags.tagged(f'models.{action}', app=instance._meta.app_label, model=instance._meta.object_name)
+    return f'models.{instance._meta.app_label}.{instance._meta.object_name}.{action}'
+
+
 def model_save(sender, **kwargs):
     """
     Handle ``save`` events of all Django models.
@@ -17,13 +24,7 @@ def model_save(sender, **kwargs):
     instance = kwargs.get('instance')
 
     # Increase statsd counter.
-    statsd.incr(
-        'models.{}.{}.{}'.format(
-            instance._meta.app_label,
-            instance._meta.object_name,
-            'create' if kwargs.get('created', False) else 'update',
-        )
-    )
+    statsd.incr(model_key(instance, 'create' if kwargs.get('created', False) else 'update'))
 
 
 def model_delete(sender, **kwargs):
@@ -33,7 +34,7 @@ def model_delete(sender, **kwargs):
     instance = kwargs.get('instance')
 
     # Increase statsd counter.
-    statsd.incr(f'models.{instance._meta.app_label}.{instance._meta.object_name}.delete')
+    statsd.incr(model_key(instance, 'delete'))
 
 
 if getattr(settings, 'STATSD_MODEL_SIGNALS', False):  # pragma: no cover
@@ -43,7 +44,10 @@ if getattr(settings, 'STATSD_MODEL_SIGNALS', False):  # pragma: no cover
 
 def logged_in(sender, request, user, **kwargs):
     statsd.incr('auth.login.success')
-    statsd.incr('auth.backends.{}'.format(user.backend.replace('.', '_')))
+    if tags.TAG_FORMAT:
+        statsd.incr(tags.tagged('auth.backends', backend=user.backend))
+    else:
+        statsd.incr('auth.backends.{}'.format(user.backend.replace('.', '_')))
 
 
 def logged_out(sender, request, user, **kwargs):
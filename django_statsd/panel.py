@@ -6,6 +6,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ungettext
 
 from django_statsd.clients import statsd
+from django_statsd.patches.db import slow_queries
 
 
 def munge(stats):
@@ -111,5 +112,6 @@ class StatsdPanel(Panel):
                 'statsd': munge(self.statsd.cache),
                 'timings': times(self.statsd.timings),
                 'timings_summary': times_summary(self.statsd.timings),
+                'slow_queries': list(slow_queries),
             }
         )
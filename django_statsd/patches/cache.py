@@ -1,11 +1,62 @@
-from django.core import cache
-from django.core.cache.backends.base import BaseCache
+import pickle
+import random
+import time
 
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from django_statsd import tags
+from django_statsd.aggregation import get_cache_hits
+from django_statsd.clients import statsd
 from django_statsd.patches.utils import wrap
 
+# The cache methods that are timed. Their async variants (``aget``, ...) are timed with the same keys.
+TIMED_METHODS = (
+    'get',
+    'get_many',
+    'get_or_set',
+    'has_key',
+    'set',
+    'set_many',
+    'add',
+    'touch',
+    'incr',
+    'decr',
+    'delete',
+    'delete_many',
+    'clear',
+)
+
+# The methods that also count the cache hits and misses. These are methods of the tracker, that call the timed method.
+COUNTED_METHODS = frozenset(['get', 'get_many', 'get_or_set', 'has_key'])
+
+# The methods that also measure the values that are written, when the payload sizes are measured.
+SIZED_METHODS = frozenset(['set', 'set_many'])
+
+# The methods of ``BaseCache``, which the tracker subclasses but must look up on the backend.
+BASE_CACHE_METHODS = tuple(name for name, value in vars(BaseCache).items() if callable(value) and name[0] != '_')
+
+PAYLOAD_SIZES = getattr(settings, 'STATSD_CACHE_PAYLOAD_SIZES', False)
+PAYLOAD_SAMPLE_RATE = getattr(settings, 'STATSD_CACHE_PAYLOAD_SAMPLE_RATE', 0.01)
+
+_missing = object()
+
 
 def key(cache, attr):
-    return 'cache.{}.{}'.format(cache.__module__.split('.')[-1], attr)
+    backend = cache.__module__.split('.')[-1]
+    if tags.TAG_FORMAT:
+        return tags.tagged(f'cache.{attr}', backend=backend)
+    return f'cache.{backend}.{attr}'
+
+
+def alias_key(alias, attr):
+    """
+    Return the key ``cache.<alias>.<attr>``, or ``cache.<attr>`` with the alias as a tag.
+    """
+    if tags.TAG_FORMAT:
+        return tags.tagged(f'cache.{attr}', alias=alias)
+    return f'cache.{alias}.{attr}'
 
 
 class StatsdTracker(BaseCache):
@@ -22,5 +73,226 @@ class StatsdTracker(BaseCache):
         return wrap(getattr(self.cache, attr), key(self.cache, attr))
 
 
+def measure(value):
+    """
+    Return the size of `value` in bytes, pickled like most cache backends do.
+    """
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def timed(method, stat):
+    def timed_method(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            statsd.timing(stat, (time.perf_counter_ns() - start) / 1e6)
+
+    return timed_method
+
+
+def atimed(method, stat):
+    async def timed_method(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            statsd.timing(stat, (time.perf_counter_ns() - start) / 1e6)
+
+    return timed_method
+
+
+class CacheTracker(BaseCache):
+    """
+    Times the calls to a cache backend as ``cache.<backend>.<method>``, and counts the hits and misses of ``get``,
+    ``get_many`` (per key), ``get_or_set`` and ``has_key`` as ``cache.<alias>.hits`` and ``cache.<alias>.misses``.
+    During a request, the hits and misses are summed and sent once by the timing middleware.
+
+    With `PAYLOAD_SIZES`, a sample of the values that are written and read is pickled, and their sizes and pickling
+    times are sent as ``cache.<alias>.<set|get>.bytes`` and ``cache.<alias>.<set|get>.serialize`` timings.
+
+    The timed methods are wrapped once, when the tracker is built, and stored on the tracker, so a call costs one extra
+    function call. All other attributes are looked up on the backend. The tracker is a ``BaseCache`` for third party
+    code that checks for one, like `StatsdTracker`, but the methods of ``BaseCache`` are taken from the backend as well.
+    """
+
+    def __init__(self, cache, alias):
+        self.cache = cache
+        self.alias = alias.replace('.', '_')
+        self.hits_key = alias_key(self.alias, 'hits')
+        self.misses_key = alias_key(self.alias, 'misses')
+        self.set_payload_keys = (alias_key(self.alias, 'set.bytes'), alias_key(self.alias, 'set.serialize'))
+        self.get_payload_keys = (alias_key(self.alias, 'get.bytes'), alias_key(self.alias, 'get.serialize'))
+        self.payload_sample_rate = PAYLOAD_SAMPLE_RATE if PAYLOAD_SIZES else 0
+        wrapped = COUNTED_METHODS | SIZED_METHODS if self.payload_sample_rate else COUNTED_METHODS
+        for name in TIMED_METHODS:
+            stat = key(cache, name)
+            # The counting and measuring methods are defined on the class, and call the timed methods under a private
+            # name. The methods that don't need to be wrapped are stored under their own name, which hides the ones of
+            # the class.
+            prefix = '_timed_' if name in wrapped else ''
+            if hasattr(cache, name):
+                setattr(self, f'{prefix}{name}', timed(getattr(cache, name), stat))
+            if hasattr(cache, f'a{name}'):
+                setattr(self, f'{prefix}a{name}', atimed(getattr(cache, f'a{name}'), stat))
+        # The methods of BaseCache would hide the ones of the backend, e.g. its make_key or close.
+        for name in BASE_CACHE_METHODS:
+            if name not in vars(self) and name not in vars(CacheTracker) and hasattr(cache, name):
+                setattr(self, name, getattr(cache, name))
+
+    def __getattr__(self, attr):
+        return getattr(self.cache, attr)
+
+    def count(self, hits, misses):
+        cache_hits = get_cache_hits()
+        if cache_hits is not None:
+            cache_hits.add(self.alias, hits, misses)
+            return
+        if hits:
+            statsd.incr(self.hits_key, hits)
+        if misses:
+            statsd.incr(self.misses_key, misses)
+
+    def measure(self, keys, values):
+        """
+        Send the sizes of a sample of `values` and the time it took to pickle them, with `keys`: the keys of the sizes
+        and the times.
+
+        The values are sampled here, so only the sampled ones are pickled, and they are sent with a rate of 1: the
+        client would otherwise sample them again. The number of sizes is the number of sampled values, not scaled back
+        up.
+
+        Values that can't be pickled are skipped: a backend that doesn't pickle (e.g. the dummy cache) accepts them, and
+        measuring them must not make the call fail.
+        """
+        bytes_key, serialize_key = keys
+        rate = self.payload_sample_rate
+        for value in values:
+            if random.random() < rate:
+                start = time.perf_counter_ns()
+                try:
+                    size = measure(value)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    continue
+                statsd.timing(serialize_key, (time.perf_counter_ns() - start) / 1e6, 1)
+                statsd.timing(bytes_key, size, 1)
+
+    def get(self, key, default=None, version=None):
+        value = self._timed_get(key, _missing, version=version)
+        if value is _missing:
+            self.count(0, 1)
+            return default
+        self.count(1, 0)
+        if self.payload_sample_rate:
+            self.measure(self.get_payload_keys, (value,))
+        return value
+
+    async def aget(self, key, default=None, version=None):
+        value = await self._timed_aget(key, _missing, version=version)
+        if value is _missing:
+            self.count(0, 1)
+            return default
+        self.count(1, 0)
+        if self.payload_sample_rate:
+            self.measure(self.get_payload_keys, (value,))
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = self._timed_get_many(keys, version=version)
+        self.count(len(values), len(keys) - len(values))
+        if self.payload_sample_rate:
+            self.measure(self.get_payload_keys, values.values())
+        return values
+
+    async def aget_many(self, keys, version=None):
+        keys = list(keys)
+        values = await self._timed_aget_many(keys, version=version)
+        self.count(len(values), len(keys) - len(values))
+        if self.payload_sample_rate:
+            self.measure(self.get_payload_keys, values.values())
+        return values
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        missed = []
+
+        def get_default():
+            # Only called when the key is missing.
+            missed.append(True)
+            return default() if callable(default) else default
+
+        value = self._timed_get_or_set(key, get_default, timeout=timeout, version=version)
+        if missed:
+            self.count(0, 1)
+        else:
+            self.count(1, 0)
+        return value
+
+    async def aget_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        missed = []
+
+        def get_default():
+            missed.append(True)
+            return default() if callable(default) else default
+
+        value = await self._timed_aget_or_set(key, get_default, timeout=timeout, version=version)
+        if missed:
+            self.count(0, 1)
+        else:
+            self.count(1, 0)
+        return value
+
+    def has_key(self, key, version=None):
+        found = self._timed_has_key(key, version=version)
+        if found:
+            self.count(1, 0)
+        else:
+            self.count(0, 1)
+        return found
+
+    async def ahas_key(self, key, version=None):
+        found = await self._timed_ahas_key(key, version=version)
+        if found:
+            self.count(1, 0)
+        else:
+            self.count(0, 1)
+        return found
+
+    # Only used with the payload sizes, see __init__.
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.measure(self.set_payload_keys, (value,))
+        return self._timed_set(key, value, timeout=timeout, version=version)
+
+    async def aset(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.measure(self.set_payload_keys, (value,))
+        return await self._timed_aset(key, value, timeout=timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self.measure(self.set_payload_keys, data.values())
+        return self._timed_set_many(data, timeout=timeout, version=version)
+
+    async def aset_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self.measure(self.set_payload_keys, data.values())
+        return await self._timed_aset_many(data, timeout=timeout, version=version)
+
+
 def patch():
-    cache.cache = StatsdTracker(cache.cache)
+    """
+    Track every cache in ``django.core.cache.caches``, including ``django.core.cache.cache``. The caches are created
+    per thread, so the ones that already exist are tracked now and the others when they are created. The caches that
+    don't exist yet aren't created here.
+    """
+    create_connection = caches.create_connection
+    if getattr(create_connection, 'tracked', False):
+        return
+
+    def create_tracked_connection(alias):
+        return CacheTracker(create_connection(alias), alias)
+
+    create_tracked_connection.tracked = True
+    caches.create_connection = create_tracked_connection
+    # The aliases of caches.all(initialized_only=True), which only returns the caches.
+    for alias in caches:
+        connection = getattr(caches._connections, alias, None)
+        if connection is not None and not isinstance(connection, CacheTracker):
+            caches[alias] = CacheTracker(connection, alias)
@@ -1,30 +1,118 @@
+import re
+import time
+from collections import deque, namedtuple
+
+from django.conf import settings
 from django.db.backends import utils
 
+from django_statsd import tags
+from django_statsd.aggregation import record_query
 from django_statsd.clients import statsd
 from django_statsd.patches.utils import patch_method
+from django_statsd.sql import HeavyHitters, fingerprint, get_table
+
+FINGERPRINTS = getattr(settings, 'STATSD_DB_FINGERPRINTS', False)
+TABLE_METRICS = getattr(settings, 'STATSD_DB_TABLE_METRICS', False)
+TABLES = getattr(settings, 'STATSD_DB_TABLES', None)
+if TABLES is not None:
+    TABLES = frozenset(table.lower() for table in TABLES)
+TABLE_LIMIT = getattr(settings, 'STATSD_DB_TABLE_LIMIT', 100)
+SLOW_QUERY_MS = getattr(settings, 'STATSD_DB_SLOW_QUERY_MS', None)
+# Leave the queries of a request to its totals (``STATSD_DB_REQUEST_STATS``) instead of timing each of them.
+REQUEST_STATS_ONLY = getattr(settings, 'STATSD_DB_REQUEST_STATS_ONLY', False)
+
+# The fingerprints with the highest total time, the others are sent as ``other``.
+heavy_hitters = HeavyHitters(size=getattr(settings, 'STATSD_DB_FINGERPRINT_TOP', 50))
+
+# A query that took at least `SLOW_QUERY_MS`, with its statement normalized so no parameters are kept.
+SlowQuery = namedtuple('SlowQuery', ['time', 'alias', 'ms', 'sql'])
+
+# The last slow queries of this process, oldest first.
+slow_queries = deque(maxlen=getattr(settings, 'STATSD_DB_SLOW_QUERY_RESERVOIR', 100))
+
+# The tables that got their own keys, up to `TABLE_LIMIT` when there is no `TABLES` whitelist.
+_seen_tables = set()
+
+
+def key(db, attr, **values):
+    """
+    Return the key ``db.<executable>.<alias>.<attr>``, followed by the `values`. With a tag format, the executable,
+    alias and `values` are tags of ``db.<attr>`` instead.
+    """
+    if tags.TAG_FORMAT:
+        return tags.tagged(f'db.{attr}', executable=db.client.executable_name, alias=db.alias, **values)
+    return '.'.join(['db', db.client.executable_name, db.alias, attr, *values.values()])
 
 
-def key(db, attr):
-    return f'db.{db.client.executable_name}.{db.alias}.{attr}'
+# Only the leading token decides the query type, so there is no need to scan or copy the rest of a (huge) query.
+_leading_token = re.compile(r'\s*(\S+)').match
 
 
 def _get_query_type(query):
-    return (query.split(None, 1) or ['__empty__'])[0].lower()
+    match = _leading_token(query)
+    return match.group(1).lower() if match else '__empty__'
+
+
+def _get_table_name(query):
+    table = get_table(query)
+    if table is None:
+        return None
+    if TABLES is not None:
+        return table if table in TABLES else 'other'
+    if table not in _seen_tables:
+        if len(_seen_tables) >= TABLE_LIMIT:
+            return 'other'
+        _seen_tables.add(table)
+    return table
+
+
+def report_query(db, query, query_type, ms):
+    """
+    Send and count what the instrumentation collects for a query, on top of the timing of its type. Return whether that
+    timing should be sent, which it isn't with `REQUEST_STATS_ONLY` when the query is counted for a request.
+    """
+    counted = record_query(query_type, ms)
+    if FINGERPRINTS:
+        query_fingerprint, normalized = fingerprint(query)
+        if not heavy_hitters.add(query_fingerprint, ms, normalized):
+            query_fingerprint = 'other'
+        statsd.timing(key(db, 'fingerprint', fingerprint=query_fingerprint), ms)
+    if SLOW_QUERY_MS is not None and ms >= SLOW_QUERY_MS:
+        statsd.incr(key(db, 'slow'))
+        slow_queries.append(SlowQuery(time.time(), db.alias, ms, fingerprint(query)[1]))
+    if TABLE_METRICS:
+        table = _get_table_name(query)
+        if table is not None:
+            if tags.TAG_FORMAT:
+                stat = key(db, 'table', table=table, type=query_type)
+            else:
+                stat = key(db, table, type=query_type)
+            statsd.timing(stat, ms)
+    return not (counted and REQUEST_STATS_ONLY)
+
+
+def timed_query(method, cursor, name, query, *args, **kwargs):
+    query_type = _get_query_type(query)
+    timer = statsd.timer(key(cursor.db, name, type=query_type))
+    timer.start()
+    try:
+        return method(cursor, query, *args, **kwargs)
+    finally:
+        timer.stop(send=False)
+        if report_query(cursor.db, query, query_type, timer.ms):
+            timer.send()
 
 
 def patched_execute(orig_execute, self, query, *args, **kwargs):
-    with statsd.timer(key(self.db, f'execute.{_get_query_type(query)}')):
-        return orig_execute(self, query, *args, **kwargs)
+    return timed_query(orig_execute, self, 'execute', query, *args, **kwargs)
 
 
 def patched_executemany(orig_executemany, self, query, *args, **kwargs):
-    with statsd.timer(key(self.db, f'executemany.{_get_query_type(query)}')):
-        return orig_executemany(self, query, *args, **kwargs)
+    return timed_query(orig_executemany, self, 'executemany', query, *args, **kwargs)
 
 
 def patched_callproc(orig_callproc, self, query, *args, **kwargs):
-    with statsd.timer(key(self.db, f'callproc.{_get_query_type(query)}')):
-        return orig_callproc(self, query, *args, **kwargs)
+    return timed_query(orig_callproc, self, 'callproc', query, *args, **kwargs)
 
 
 def patch():
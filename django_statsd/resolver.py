@@ -0,0 +1,55 @@
+import socket
+import threading
+from time import perf_counter
+
+
+def resolve(host, port, family=socket.AF_INET):
+    """
+    Look up the address that UDP packets for the statsd host should be sent to, for a socket of `family`.
+    """
+    return socket.getaddrinfo(host, port, family, socket.SOCK_DGRAM)[0][4]
+
+
+class HostResolver:
+    """
+    Re-resolves the statsd host in a daemon thread, so the DNS lookup never happens on a request thread.
+
+    The address of the client is only replaced when the lookup returns a different one. The time spent in the lookup
+    and the failed lookups are sent through the client as ``statsd.resolve.time`` and ``statsd.resolve.failure``.
+
+    The host is looked up for the `family` of the socket of the client, so an IPv6 client gets IPv6 addresses.
+    """
+
+    def __init__(self, client, host, port, interval, family=socket.AF_INET, resolve=resolve):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.family = family
+        self.resolve = resolve
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='statsd-resolver', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.resolve_once()
+
+    def resolve_once(self):
+        start = perf_counter()
+        try:
+            addr = self.resolve(self.host, self.port, self.family)
+        except OSError:
+            self.client.incr('statsd.resolve.failure')
+            return
+        self.client.timing('statsd.resolve.time', 1000.0 * (perf_counter() - start))
+
+        if addr != self.client._addr:
+            self.client._addr = addr
+            self.client.incr('statsd.resolve.changed')
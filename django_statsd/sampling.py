@@ -0,0 +1,175 @@
+import re
+import threading
+from fnmatch import translate
+from time import monotonic
+
+# The lookups of the sample rates are cached per key. Keys are built from a small set of names, but they are not
+# guaranteed to be, so the cache is cleared when it grows beyond this size.
+RATE_CACHE_SIZE = 10000
+
+
+class SampleRates:
+    """
+    The sample rates of the metric keys, configured as a dict of shell-style patterns (e.g. ``{'db.*': 0.1}``).
+
+    The most specific (longest) matching pattern decides the rate of a key, and keys that don't match any pattern are
+    sent with a rate of 1. The patterns are only matched once per key, after that the rate is a dict lookup.
+    """
+
+    def __init__(self, rates=None):
+        patterns = sorted((rates or {}).items(), key=lambda item: len(item[0]), reverse=True)
+        self.patterns = [(re.compile(translate(pattern)).match, float(rate)) for pattern, rate in patterns]
+        self._cache = {}
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def get(self, stat):
+        """
+        Return the sample rate of `stat`.
+        """
+        try:
+            return self._cache[stat]
+        except KeyError:
+            pass
+
+        rate = self.match(stat)
+        if len(self._cache) >= RATE_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[stat] = rate
+        return rate
+
+    def match(self, stat):
+        """
+        Return the configured rate of `stat`, without the cache.
+        """
+        for match, rate in self.patterns:
+            if match(stat):
+                return rate
+        return 1.0
+
+
+class _Family:
+    __slots__ = ('sent', 'rate')
+
+    def __init__(self):
+        # The metrics that would have been sent at the configured rates.
+        self.sent = 0.0
+        self.rate = 1.0
+
+
+class AdaptiveSampleRates(SampleRates):
+    """
+    Sample rates that throttle under load.
+
+    The metrics are counted per key family, the first part of the key (``db``, ``cache``, ``view``, ...), without its
+    tags. Every `interval` seconds of `clock`, the rate of a family that would send more than `budget` metrics per
+    second at its configured rates is lowered so about `budget` metrics per second are sent, and it is raised again
+    when the load drops. The rate of a key is its configured rate times the rate of its family.
+
+    Every change of a family rate is sent through `report` as a ``statsd.sample_rate.<family>`` gauge. The counting is
+    not locked, so a few metrics can be missed under contention, which only makes the rates slightly less exact.
+    """
+
+    def __init__(self, rates=None, budget=1000, interval=1.0, clock=monotonic, report=None):
+        super().__init__(rates)
+        self.budget = budget
+        self.interval = interval
+        self.clock = clock
+        self.report = report
+        self.families = {}
+        self._window_start = clock()
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return True
+
+    def get(self, stat):
+        now = self.clock()
+        if now - self._window_start >= self.interval:
+            self.adjust(now)
+
+        try:
+            rate, family = self._cache[stat]
+        except KeyError:
+            name = stat.partition(';')[0].partition('.')[0]
+            family = self.families.get(name)
+            if family is None:
+                family = self.families.setdefault(name, _Family())
+            rate = self.match(stat)
+            if len(self._cache) >= RATE_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[stat] = (rate, family)
+
+        family.sent += rate
+        return rate * family.rate
+
+    def adjust(self, now):
+        """
+        Set the family rates from the calls since the last adjustment.
+        """
+        if not self._lock.acquire(blocking=False):
+            # Another thread is already adjusting them.
+            return
+        try:
+            elapsed = now - self._window_start
+            if elapsed < self.interval:
+                return
+            self._window_start = now
+            for name, family in list(self.families.items()):
+                sent, family.sent = family.sent, 0.0
+                rate = 1.0
+                if sent > self.budget * elapsed:
+                    # Keep the rate short on the wire.
+                    rate = max(round(self.budget * elapsed / sent, 4), 0.0001)
+                if rate != family.rate:
+                    family.rate = rate
+                    if self.report is not None:
+                        self.report(f'statsd.sample_rate.{name}', rate)
+        finally:
+            self._lock.release()
+
+
+def sampled_methods(methods, rates):
+    """
+    Wrap the ``incr``, ``decr``, ``timing`` and ``timer`` `methods` of a client, so the metrics that are sent without
+    a rate get the rate of their key. The rate is sent along, so the counts and timings stay unbiased.
+
+    Gauges and sets are not sampled: the value of a dropped gauge or set member is lost, not estimated.
+    """
+    methods = dict(methods)
+    get_rate = rates.get
+
+    if 'incr' in methods:
+        incr = methods['incr']
+
+        def sampled_incr(stat, count=1, rate=None):
+            return incr(stat, count, get_rate(stat) if rate is None else rate)
+
+        methods['incr'] = sampled_incr
+
+    if 'decr' in methods:
+        decr = methods['decr']
+
+        def sampled_decr(stat, count=1, rate=None):
+            return decr(stat, count, get_rate(stat) if rate is None else rate)
+
+        methods['decr'] = sampled_decr
+
+    if 'timing' in methods:
+        timing = methods['timing']
+
+        def sampled_timing(stat, delta, rate=None):
+            return timing(stat, delta, get_rate(stat) if rate is None else rate)
+
+        methods['timing'] = sampled_timing
+
+    if 'timer' in methods:
+        timer = methods['timer']
+
+        def sampled_timer(stat, rate=None):
+            return timer(stat, get_rate(stat) if rate is None else rate)
+
+        methods['timer'] = sampled_timer
+
+    return methods
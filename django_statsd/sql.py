@@ -0,0 +1,116 @@
+import re
+import threading
+from functools import lru_cache
+from hashlib import blake2b
+
+from django.conf import settings
+
+FINGERPRINT_CACHE_SIZE = getattr(settings, 'STATSD_DB_FINGERPRINT_CACHE_SIZE', 1024)
+TABLE_CACHE_SIZE = getattr(settings, 'STATSD_DB_TABLE_CACHE_SIZE', 1024)
+
+_literals = re.compile(
+    r"""
+    '(?:[^']|'')*'                  # strings
+    | \b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b  # numbers
+    | %s | %\(\w+\)s | \$\d+ | \?    # placeholders
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+_in_lists = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_value_lists = re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+')
+_whitespace = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """
+    Return `sql` without its literals and parameters, so all runs of a statement look the same: strings, numbers and
+    placeholders become ``?``, ``IN`` lists become ``IN (...)`` and the rows of a multi-row ``VALUES`` become one.
+    """
+    sql = _literals.sub('?', sql)
+    sql = _in_lists.sub('IN (...)', sql)
+    sql = _value_lists.sub(r'\1', sql)
+    return _whitespace.sub(' ', sql).strip()
+
+
+@lru_cache(maxsize=FINGERPRINT_CACHE_SIZE)
+def fingerprint(sql):
+    """
+    Return the fingerprint of `sql`, a short hash of the normalized statement, and the normalized statement.
+
+    The statements of an application are mostly the same strings over and over, so they are only normalized once.
+    """
+    normalized = normalize(sql)
+    return blake2b(normalized.encode(), digest_size=6).hexdigest(), normalized
+
+
+# The target of the first ``FROM``, ``INTO`` or ``UPDATE``, which may be quoted and qualified with a schema.
+_table = re.compile(
+    r"""\b(?:FROM|INTO|UPDATE)\s+((?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)(?:\.(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+))*)""",
+    re.IGNORECASE,
+)
+_quotes = re.compile(r'["`\[\]]')
+
+
+@lru_cache(maxsize=TABLE_CACHE_SIZE)
+def get_table(sql):
+    """
+    Return the primary table of `sql`: the target of its first ``FROM``, ``INTO`` or ``UPDATE``, without quotes and
+    with dots replaced by underscores. Returns None for statements without a table (``BEGIN``, ``SAVEPOINT``, ...).
+
+    This is a heuristic, not a parser: only the first match counts, also when that is in a subquery.
+    """
+    match = _table.search(sql)
+    if match is None:
+        return None
+    return _quotes.sub('', match.group(1)).replace('.', '_').lower()
+
+
+class HeavyHitters:
+    """
+    The `size` items with the highest total weight, tracked with the Space-Saving algorithm in a fixed amount of
+    memory.
+
+    Every item that is added is tracked. When all `size` slots are taken, the item with the lowest total is replaced
+    and the new item inherits that total as its error. An item is a heavy hitter once the weight it has certainly
+    gathered (its total minus its error) is at least that lowest total, so items that come and go once don't count.
+    """
+
+    def __init__(self, size=50):
+        self.size = size
+        self._totals = {}
+        self._errors = {}
+        self._labels = {}
+        self._min_total = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, item, weight, label=None):
+        """
+        Add `weight` to the total of `item`, and return whether it is a heavy hitter. The `label` of an item is kept
+        while it is tracked.
+        """
+        totals = self._totals
+        with self._lock:
+            if item in totals:
+                totals[item] += weight
+            elif len(totals) < self.size:
+                totals[item] = weight
+                self._errors[item] = 0.0
+                self._labels[item] = label
+            else:
+                evicted = min(totals, key=totals.get)
+                error = totals.pop(evicted)
+                del self._errors[evicted]
+                del self._labels[evicted]
+                totals[item] = error + weight
+                self._errors[item] = error
+                self._labels[item] = label
+                self._min_total = min(totals.values())
+            return totals[item] - self._errors[item] >= self._min_total
+
+    def top(self):
+        """
+        Return the tracked items as ``(item, total, label)``, highest total first.
+        """
+        with self._lock:
+            top = [(item, total, self._labels[item]) for item, total in self._totals.items()]
+        return sorted(top, key=lambda entry: entry[1], reverse=True)
@@ -0,0 +1,63 @@
+import re
+
+from django.conf import settings
+
+TAG_FORMATS = ('dogstatsd', 'graphite')
+
+# With a tag format, the built-in metrics are sent as one key with tags, instead of encoding the tags in the key.
+TAG_FORMAT = getattr(settings, 'STATSD_TAG_FORMAT', None)
+if TAG_FORMAT is not None and TAG_FORMAT not in TAG_FORMATS:
+    raise ValueError('STATSD_TAG_FORMAT must be one of: {}'.format(', '.join(TAG_FORMATS)))
+
+# The characters that separate the parts of a metric in either format.
+_unsafe = re.compile(r'[;:|,=#@\s]')
+
+
+def tagged(name, /, **tags):
+    """
+    Return the key of `name` with `tags`, as ``<name>;<tag>=<value>;...``, the Graphite format. Tags whose value is None
+    are left out, and the separators of either format are replaced by underscores in the values.
+    """
+    parts = [name]
+    for tag, value in tags.items():
+        if value is not None:
+            parts.append('{}={}'.format(tag, _unsafe.sub('_', str(value))))
+    return ';'.join(parts)
+
+
+def suffixed(stat, suffix):
+    """
+    Return `stat` with `suffix` added to its name, before its tags if it has any.
+    """
+    name, separator, tags = stat.partition(';')
+    return f'{name}.{suffix}{separator}{tags}'
+
+
+def dogstatsd_prepare(prepare):
+    """
+    Wrap the ``_prepare`` method of a client, so tagged keys are sent in the DogStatsD format:
+    ``<name>:<value>|<type>|@<rate>|#<tag>:<value>,...``.
+    """
+
+    def prepare_tagged(stat, value, rate):
+        name, separator, tags = stat.partition(';')
+        data = prepare(name, value, rate)
+        if data and separator:
+            data = '{}|#{}'.format(data, tags.replace('=', ':').replace(';', ','))
+        return data
+
+    return prepare_tagged
+
+
+def dogstatsd_pipeline(pipeline):
+    """
+    Wrap the ``pipeline`` method of a client, so the pipelines it returns send tagged keys in the DogStatsD format as
+    well. The client sends negative gauges through a pipeline too.
+    """
+
+    def pipeline_tagged():
+        pipe = pipeline()
+        pipe._prepare = dogstatsd_prepare(pipe._prepare)
+        return pipe
+
+    return pipeline_tagged
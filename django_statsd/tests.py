@@ -1,21 +1,38 @@
+import asyncio
 import logging
+import os
+import socket
+import subprocess
 import sys
-from time import sleep
+import threading
+from collections import deque
+from io import StringIO
+from time import sleep, time
 from unittest import TestCase
 from unittest.mock import Mock, patch
 
+from asgiref.sync import iscoroutinefunction
+from celery import Celery
 from celery import signals as celery_signals
 from django import VERSION as DJANGO_VERSION
 from django.conf import settings
 from django.contrib.auth import signals as auth_signals
 from django.core.cache import cache as django_cache
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.management import call_command
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
 from django.http import Http404, HttpResponse, HttpResponseForbidden
 from django.test import TestCase as DjangoTestCase
 from django.test import override_settings
 from django.test.client import RequestFactory
+from django.utils.functional import SimpleLazyObject
 from logutils import dictconfig
 from pytest import raises
+from statsd.client import StatsClient as UDPStatsClient
 from testfixtures import log_capture
 
 try:
@@ -23,11 +40,19 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 
-from django_statsd import middleware
-from django_statsd.clients import StatsdClientProxy
-from django_statsd.patches import import_patches, utils
+from django_statsd import aggregation, middleware, tags
+from django_statsd.celery_hooks import PUBLISHED_AT_HEADER, TaskKeyRegistry, TaskStartTimes, WorkerStats
+from django_statsd.clients import StatsdClientProxy, get_config
+from django_statsd.clients import statsd as proxy_statsd
+from django_statsd.clients.aio import StatsClient as AsyncioStatsClient
+from django_statsd.clients.batch import StatsClient as BatchStatsClient
+from django_statsd.clients.threaded import StatsClient as ThreadedStatsClient
+from django_statsd.histogram import DEFAULT_BUCKETS, Histograms, linear_buckets, log_linear_buckets
+from django_statsd.patches import db, db_wrapper, import_patches, utils
 from django_statsd.patches.cache import (
+    CacheTracker,
     StatsdTracker,
+    measure,
 )
 from django_statsd.patches.cache import (
     patch as cache_patch,
@@ -40,6 +65,9 @@ from django_statsd.patches.db import (
     patched_execute,
     patched_executemany,
 )
+from django_statsd.resolver import HostResolver, resolve
+from django_statsd.sampling import AdaptiveSampleRates, SampleRates
+from django_statsd.sql import HeavyHitters, fingerprint, get_table, normalize
 from django_statsd.views import _process_summaries, process_key
 
 cfg = {
@@ -62,6 +90,10 @@ cfg = {
 }
 
 
+def add(x, y):
+    return x + y
+
+
 class TestIncr(DjangoTestCase):
     def setUp(self):
         self.req = RequestFactory().get('/')
@@ -233,6 +265,104 @@ class TestTiming(TestCase):
         for expected, (args, kwargs) in zip(names, statsd_mock.timing.call_args_list):
             self.assertEqual(expected, args[0])
 
+    def test_request_timing_sub_millisecond(self):
+        func = lambda x: x  # noqa: E731
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_view(self.req, func, tuple(), dict())
+            gmw.process_response(self.req, self.res)
+        ms = statsd_mock.timing.call_args_list[0][0][1]
+        assert isinstance(ms, float)
+        assert 0 < ms < 1000
+
+    def test_request_timing_clock_jump(self):
+        func = lambda x: x  # noqa: E731
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with (
+            patch('django_statsd.middleware.statsd') as statsd_mock,
+            patch('time.time', side_effect=[1e9, 0, -1e9, 2e9]),
+        ):
+            gmw.process_view(self.req, func, tuple(), dict())
+            gmw.process_response(self.req, self.res)
+        for args, kwargs in statsd_mock.timing.call_args_list:
+            assert 0 <= args[1] < 1000
+
+    def test_view_keys_cached(self):
+        func = lambda x: x  # noqa: E731
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        middleware.view_keys.cache_clear()
+        with patch('django_statsd.middleware.statsd'):
+            for _ in range(3):
+                gmw.process_view(self.req, func, tuple(), dict())
+                gmw.process_response(self.req, self.res)
+        info = middleware.view_keys.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+        self.assertEqual(
+            self.req._view_keys,
+            (
+                func.__module__,
+                func.__name__,
+                f'view.{func.__module__}.{func.__name__}.GET',
+                f'view.{func.__module__}.GET',
+                'view.GET',
+                f'view.{func.__module__}.{func.__name__}.db_queries',
+                f'view.{func.__module__}.{func.__name__}.db_time',
+            ),
+        )
+
+    @override_settings(STATSD_DB_REQUEST_STATS=True)
+    def test_request_db_stats(self):
+        func = lambda x: x  # noqa: E731
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_request(self.req)
+            gmw.process_view(self.req, func, tuple(), dict())
+            aggregation.record_query('select', 1.5)
+            aggregation.record_query('select', 2.0)
+            aggregation.record_query('update', 0.5)
+            gmw.process_response(self.req, self.res)
+        # Queries after the response are not counted anymore.
+        aggregation.record_query('select', 1.0)
+
+        prefix = f'view.{func.__module__}.{func.__name__}'
+        timings = {args[0]: args[1] for args, kwargs in statsd_mock.timing.call_args_list}
+        self.assertEqual(timings[f'{prefix}.db_queries'], 3)
+        self.assertEqual(timings[f'{prefix}.db_time'], 4.0)
+        self.assertCountEqual(
+            statsd_mock.incr.call_args_list,
+            [((f'{prefix}.db_queries.select', 2),), ((f'{prefix}.db_queries.update', 1),)],
+        )
+
+    def test_request_db_stats_disabled(self):
+        func = lambda x: x  # noqa: E731
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_request(self.req)
+            gmw.process_view(self.req, func, tuple(), dict())
+            aggregation.record_query('select', 1.5)
+            gmw.process_response(self.req, self.res)
+        self.assertEqual(statsd_mock.timing.call_count, 3)
+        statsd_mock.incr.assert_not_called()
+
+    def test_request_timing_unhashable_view(self):
+        class View:
+            __hash__ = None
+
+            def __call__(self, request):
+                return request
+
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_view(self.req, View(), tuple(), dict())
+            gmw.process_response(self.req, self.res)
+        self.assertEqual(statsd_mock.timing.call_args_list[0][0][0], f'view.{View.__module__}.View.GET')
+
+    def test_request_timing_flushes_client(self):
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_response(self.req, self.res)
+        assert statsd_mock.flush.called
+
 
 class TestClient(TestCase):
     @override_settings(STATSD_CLIENT='django_statsd.clients.toolbar')
@@ -308,6 +438,1016 @@ class TestClient(TestCase):
         statsd.incr('test')
         self.assertNotEqual(old_client, statsd._client)
 
+    @override_settings(STATSD_CLIENT='django_statsd.clients.toolbar')
+    def test_settings_read_once(self):
+        statsd = StatsdClientProxy()
+        with patch('django_statsd.clients.get_config', wraps=get_config) as get_config_mock:
+            for _ in range(100):
+                statsd.incr('test')
+                statsd.timing('test', 1)
+        self.assertEqual(get_config_mock.call_count, 1)
+        self.assertEqual(len(statsd.cache['test|count']), 100)
+
+    @override_settings(STATSD_CLIENT='django_statsd.clients.toolbar')
+    def test_setting_changed_rebuilds_client(self):
+        statsd = StatsdClientProxy()
+        statsd.incr('test')
+        old_client = statsd._client
+        with override_settings(STATSD_PREFIX='changed'):
+            statsd.incr('test')
+            self.assertNotEqual(old_client, statsd._client)
+            self.assertEqual(statsd._client._prefix, 'changed')
+
+    @override_settings(
+        STATSD_CLIENT='django_statsd.clients.toolbar', STATSD_SAMPLE_RATES={'db.*': 0.1, 'db.*.select': 0.5}
+    )
+    def test_sample_rates(self):
+        statsd = StatsdClientProxy()
+        statsd.incr('db.default.execute.select')
+        statsd.incr('db.default.execute.insert')
+        statsd.incr('db.default.execute.insert', 1, 0.2)
+        statsd.incr('view.GET')
+        statsd.gauge('db.default.connections', 1)
+        self.assertEqual(statsd.cache['db.default.execute.select|count'], [[1, 0.5]])
+        self.assertEqual(statsd.cache['db.default.execute.insert|count'], [[1, 0.1], [1, 0.2]])
+        self.assertEqual(statsd.cache['view.GET|count'], [[1, 1.0]])
+        self.assertEqual(statsd.cache['db.default.connections|gauge'], [[1, 1]])
+
+    @override_settings(STATSD_CLIENT='statsd.client', STATSD_SAMPLE_RATES={'db.*': 0.25})
+    def test_sample_rates_on_the_wire(self):
+        statsd = StatsdClientProxy()
+        with patch.object(UDPStatsClient, '_send') as send, patch('random.random', side_effect=[0.1, 0.9, 0.9]):
+            statsd.incr('db.default.execute.select')
+            statsd.incr('db.default.execute.select')
+            with statsd.timer('db.default.execute.select'):
+                pass
+        sent = [args[0] for args, kwargs in send.call_args_list]
+        self.assertEqual(sent[0], 'db.default.execute.select:1|c|@0.25')
+        self.assertEqual(len(sent), 1)
+
+
+class TestSampleRates(TestCase):
+    def test_most_specific_pattern(self):
+        rates = SampleRates({'db.*': 0.1, 'db.*.select': 0.5, 'cache.*': 0.2})
+        self.assertEqual(rates.get('db.default.execute.select'), 0.5)
+        self.assertEqual(rates.get('db.default.execute.insert'), 0.1)
+        self.assertEqual(rates.get('cache.get'), 0.2)
+        self.assertEqual(rates.get('view.GET'), 1)
+
+    def test_matched_once(self):
+        rates = SampleRates({'db.*': 0.1})
+        rates.get('db.default.execute.select')
+        with patch.object(rates, 'patterns', []):
+            self.assertEqual(rates.get('db.default.execute.select'), 0.1)
+
+    def test_empty(self):
+        assert not SampleRates()
+        assert not SampleRates({})
+        assert SampleRates({'db.*': 0.1})
+
+
+class TestAdaptiveSampleRates(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.report = Mock()
+        self.rates = AdaptiveSampleRates({'db.*.select': 0.5}, budget=100, clock=lambda: self.now, report=self.report)
+
+    def send(self, stat, count):
+        return [self.rates.get(stat) for _ in range(count)][-1]
+
+    def test_throttles_under_load(self):
+        self.assertEqual(self.send('cache.get', 400), 1)
+        self.now = 1.0
+        self.assertEqual(self.send('cache.get', 400), 0.25)
+        self.report.assert_called_once_with('statsd.sample_rate.cache', 0.25)
+
+    def test_recovers(self):
+        self.send('cache.get', 400)
+        self.now = 1.0
+        self.send('cache.get', 10)
+        self.now = 2.0
+        self.assertEqual(self.rates.get('cache.get'), 1)
+        self.assertEqual(self.report.call_args_list[-1][0], ('statsd.sample_rate.cache', 1))
+
+    def test_families(self):
+        self.send('cache.get', 400)
+        self.send('view.GET', 50)
+        self.now = 1.0
+        self.assertEqual(self.rates.get('cache.set'), 0.25)
+        self.assertEqual(self.rates.get('view.GET'), 1)
+        self.report.assert_called_once_with('statsd.sample_rate.cache', 0.25)
+
+    def test_configured_rates(self):
+        # Only half of the selects are sent, so that is what counts against the budget.
+        self.send('db.default.execute.select', 400)
+        self.now = 1.0
+        self.assertEqual(self.rates.get('db.default.execute.select'), 0.25)
+        self.assertEqual(self.rates.get('db.default.execute.insert'), 0.5)
+
+    def test_interval(self):
+        self.send('cache.get', 399)
+        self.now = 0.5
+        self.assertEqual(self.rates.get('cache.get'), 1)
+        self.now = 2.0
+        self.assertEqual(self.rates.get('cache.get'), 0.5)
+
+    @override_settings(STATSD_CLIENT='django_statsd.clients.toolbar', STATSD_SAMPLE_BUDGET=10)
+    def test_proxy(self):
+        statsd = StatsdClientProxy()
+        statsd.incr('test')
+        rates = statsd._sample_rates
+        rates.clock = lambda: self.now
+        for _ in range(100):
+            statsd.incr('test')
+        self.now = rates._window_start + 1
+        statsd.incr('test')
+        self.assertEqual(statsd.cache['test|count'][-1], [1, 0.099])
+        self.assertEqual(statsd.cache['statsd.sample_rate.test|gauge'], [[0.099, 1]])
+
+
+class TestHistograms(TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.histograms = Histograms(
+            {'view.*': linear_buckets(10, 10, 3), 'db.*': None}, interval=10, client=self.client
+        )
+
+    def tearDown(self):
+        self.histograms.stop()
+
+    def sent(self):
+        return {args[0]: args[1] for args, kwargs in self.client.incr.call_args_list}
+
+    def test_buckets(self):
+        self.assertEqual(linear_buckets(10, 10, 3), (10, 20, 30))
+        self.assertEqual(
+            log_linear_buckets(1, 300), (1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 200, 300)
+        )
+        self.assertEqual(log_linear_buckets(0.1, 1, 2), (0.1, 0.55, 1))
+        self.assertEqual(DEFAULT_BUCKETS[-1], 60000)
+
+    def test_get(self):
+        self.assertEqual(self.histograms.get('view.GET'), (10, 20, 30))
+        self.assertEqual(self.histograms.get('db.default.execute.select'), DEFAULT_BUCKETS)
+        self.assertIsNone(self.histograms.get('cache.get'))
+
+    def test_flush(self):
+        for value in (5, 10, 11, 25, 100, 100):
+            self.histograms.add('view.GET', value)
+        self.histograms.add('cache.get', 1.5)
+        self.client.incr.assert_not_called()
+        self.histograms.flush()
+        self.assertEqual(
+            self.sent(),
+            {
+                'view.GET.bucket.10': 2,
+                'view.GET.bucket.20': 1,
+                'view.GET.bucket.30': 1,
+                'view.GET.bucket.inf': 2,
+                'view.GET.count': 6,
+                'view.GET.sum': 251,
+                'cache.get.bucket.2': 1,
+                'cache.get.count': 1,
+                'cache.get.sum': 1.5,
+            },
+        )
+
+    def test_flushes_periodically(self):
+        histograms = Histograms(interval=0.01, client=self.client)
+        try:
+            histograms.add('task.runtime', 3)
+            for _ in range(100):
+                if self.client.incr.called:
+                    break
+                sleep(0.01)
+        finally:
+            histograms.stop()
+        self.assertEqual(self.sent()['task.runtime.bucket.3'], 1)
+
+    def test_after_fork(self):
+        self.histograms.add('view.GET', 1)
+        self.histograms._after_fork()
+        self.assertEqual(self.histograms.histograms, {})
+        self.assertIsNone(self.histograms._thread)
+        self.histograms.add('view.GET', 1)
+        assert self.histograms._thread.is_alive()
+
+    def test_idle_histograms_are_dropped(self):
+        self.histograms.add('view.GET', 1)
+        self.histograms.flush()
+        self.assertEqual(list(self.histograms.histograms), ['view.GET'])
+        self.client.reset_mock()
+        self.histograms.flush()
+        self.assertEqual(self.histograms.histograms, {})
+        self.client.incr.assert_not_called()
+
+    def test_timer(self):
+        with self.histograms.timer('view.GET'):
+            pass
+        self.histograms.flush()
+        self.assertEqual(self.sent()['view.GET.bucket.10'], 1)
+
+    @override_settings(STATSD_CLIENT='django_statsd.clients.toolbar', STATSD_HISTOGRAMS={'view.*': [10, 20]})
+    def test_proxy(self):
+        statsd = StatsdClientProxy()
+        for value in (1, 15, 15):
+            statsd.timing('view.GET', value)
+        with statsd.timer('view.POST'):
+            pass
+        statsd.timing('db.default.execute.select', 1)
+        statsd.histogram('payload', 300)
+        self.assertEqual(statsd.timings[0][0], 'db.default.execute.select|timing')
+        self.assertEqual(len(statsd.timings), 1)
+        statsd._histograms.flush()
+        self.assertEqual(statsd.cache['view.GET.bucket.10|count'], [[1, 1]])
+        self.assertEqual(statsd.cache['view.GET.bucket.20|count'], [[2, 1]])
+        self.assertEqual(statsd.cache['view.POST.bucket.10|count'], [[1, 1]])
+        self.assertEqual(statsd.cache['payload.bucket.300|count'], [[1, 1]])
+
+    @override_settings(STATSD_CLIENT='django_statsd.clients.toolbar')
+    def test_setting_changed_flushes(self):
+        statsd = StatsdClientProxy()
+        statsd.histogram('payload', 3)
+        old_client = statsd._client
+        with override_settings(STATSD_HISTOGRAM_INTERVAL=60):
+            statsd.incr('test')
+            self.assertEqual(statsd._histograms.interval, 60)
+        self.assertEqual(old_client.cache['payload.count|count'], [[1, 1]])
+
+
+@patch.object(tags, 'TAG_FORMAT', 'dogstatsd')
+class TestTags(TestCase):
+    def setUp(self):
+        self.req = RequestFactory().get('/')
+        self.res = HttpResponse()
+        middleware.named_view_keys.cache_clear()
+        middleware.view_keys.cache_clear()
+
+    def tearDown(self):
+        middleware.named_view_keys.cache_clear()
+        middleware.view_keys.cache_clear()
+
+    def test_tagged(self):
+        self.assertEqual(tags.tagged('view', module='a.b', name='c', method=None), 'view;module=a.b;name=c')
+        self.assertEqual(tags.tagged('error', type='a;b:c|d,e=f#g h'), 'error;type=a_b_c_d_e_f_g_h')
+        self.assertEqual(tags.suffixed('view.db_queries;module=a', 'select'), 'view.db_queries.select;module=a')
+        self.assertEqual(tags.suffixed('view.db_queries', 'select'), 'view.db_queries.select')
+
+    @override_settings(STATSD_CLIENT='statsd.client', STATSD_PREFIX='app', STATSD_TAG_FORMAT='dogstatsd')
+    def test_dogstatsd_on_the_wire(self):
+        statsd = StatsdClientProxy()
+        with patch.object(UDPStatsClient, '_send') as send, patch('random.random', return_value=0.1):
+            statsd.incr('response;status=200;auth=false')
+            statsd.timing('db.execute;alias=default;type=select', 1.5, 0.5)
+            statsd.incr('plain')
+        sent = [args[0] for args, kwargs in send.call_args_list]
+        self.assertEqual(
+            sent,
+            [
+                'app.response:1|c|#status:200,auth:false',
+                'app.db.execute:1.500000|ms|@0.5|#alias:default,type:select',
+                'app.plain:1|c',
+            ],
+        )
+
+    @override_settings(STATSD_CLIENT='statsd.client', STATSD_PREFIX='app', STATSD_TAG_FORMAT='dogstatsd')
+    def test_dogstatsd_pipeline(self):
+        statsd = StatsdClientProxy()
+        with patch.object(UDPStatsClient, '_send') as send:
+            with statsd.pipeline() as pipe:
+                pipe.incr('response;status=200')
+                pipe.timing('view;name=index', 2)
+            statsd.gauge('workers;pool=default', -1)
+        sent = [args[0] for args, kwargs in send.call_args_list]
+        self.assertEqual(
+            sent,
+            [
+                'app.response:1|c|#status:200\napp.view:2.000000|ms|#name:index',
+                'app.workers:0|g|#pool:default\napp.workers:-1|g|#pool:default',
+            ],
+        )
+
+    @override_settings(STATSD_CLIENT='statsd.client')
+    def test_graphite_on_the_wire(self):
+        statsd = StatsdClientProxy()
+        with patch.object(tags, 'TAG_FORMAT', 'graphite'), patch.object(UDPStatsClient, '_send') as send:
+            statsd.incr('response;status=200;auth=false')
+        send.assert_called_once_with('response;status=200;auth=false:1|c')
+
+    @override_settings(STATSD_CLIENT='statsd.client')
+    def test_format_set_at_startup(self):
+        statsd = StatsdClientProxy()
+        with patch.object(UDPStatsClient, '_send') as send:
+            statsd.incr('response;status=200')
+            with override_settings(STATSD_TAG_FORMAT='graphite'):
+                statsd.incr('response;status=200')
+        self.assertEqual([args[0] for args, kwargs in send.call_args_list], ['response:1|c|#status:200'] * 2)
+
+    def test_request_timing(self):
+        func = lambda x: x  # noqa: E731
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_view(self.req, func, tuple(), dict())
+            gmw.process_response(self.req, self.res)
+        statsd_mock.timing.assert_called_once()
+        self.assertEqual(statsd_mock.timing.call_args[0][0], f'view;module={func.__module__};name=<lambda>;method=GET')
+
+    def test_request_db_stats(self):
+        func = lambda x: x  # noqa: E731
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with override_settings(STATSD_DB_REQUEST_STATS=True), patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_request(self.req)
+            gmw.process_view(self.req, func, tuple(), dict())
+            aggregation.record_query('select', 1.0)
+            gmw.process_response(self.req, self.res)
+        statsd_mock.incr.assert_called_once_with(f'view.db_queries.select;module={func.__module__};name=<lambda>', 1)
+
+    def test_response(self):
+        gmw = middleware.GraphiteMiddleware(lambda x: x)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_response(self.req, self.res)
+            gmw.process_exception(self.req, None)
+        self.assertEqual(
+            statsd_mock.incr.call_args_list,
+            [(('response;status=200;auth=false',),), (('response;status=500;auth=false',),)],
+        )
+
+    def test_db_keys(self):
+        self.assertEqual(
+            db.key(connection, 'execute', type='select'), 'db.execute;executable=sqlite3;alias=default;type=select'
+        )
+        self.assertEqual(
+            db_wrapper.StatsdExecuteWrapper(connection).get_key('insert', True),
+            'db.executemany;executable=sqlite3;alias=default;type=insert',
+        )
+        with patch.object(tags, 'TAG_FORMAT', None):
+            self.assertEqual(db.key(connection, 'execute', type='select'), 'db.sqlite3.default.execute.select')
+
+    def test_cache_keys(self):
+        tracker = CacheTracker(LocMemCache('tags', {}), 'default')
+        self.assertEqual(tracker.hits_key, 'cache.hits;alias=default')
+        with patch('django_statsd.patches.cache.statsd') as statsd_mock:
+            tracker.get('missing')
+        self.assertEqual(statsd_mock.timing.call_args[0][0], 'cache.get;backend=locmem')
+
+    def test_aggregated_keys(self):
+        client = Mock()
+        hits = aggregation.CacheHits()
+        hits.add('default', 2, 1)
+        hits.flush(client)
+        aggregator = aggregation.RequestAggregator(timers=True)
+        aggregator.timing('view;method=GET', 2)
+        aggregator.flush(client)
+        self.assertEqual(
+            [args for args, kwargs in client.incr.call_args_list],
+            [('cache.hits;alias=default', 2), ('cache.misses;alias=default', 1), ('view.count;method=GET', 1)],
+        )
+
+
+def run_and_receive(code, **statsd_settings):
+    """
+    Run `code` in a new interpreter that sends to a local UDP socket, and return the lines it has sent once it exits.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as listener:
+        listener.bind(('127.0.0.1', 0))
+        statsd_settings.update(STATSD_HOST='127.0.0.1', STATSD_PORT=listener.getsockname()[1])
+        script = f'from django.conf import settings\nsettings.configure(**{statsd_settings!r})\n{code}'
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', script], cwd=root, check=True, timeout=30)
+
+        listener.settimeout(0.5)
+        lines = []
+        while True:
+            try:
+                packet = listener.recv(65535)
+            except TimeoutError:
+                return lines
+            lines.extend(packet.decode().split('\n'))
+
+
+class TestBatchClient(TestCase):
+    def setUp(self):
+        self.client = BatchStatsClient(maxudpsize=32, flush_interval=0)
+        self.client._sock.close()
+        self.client._sock = Mock()
+
+    def sent(self):
+        return [args[0].decode() for args, kwargs in self.client._sock.sendto.call_args_list]
+
+    def test_buffers_until_flush(self):
+        self.client.incr('a')
+        self.client.incr('b', 2)
+        self.assertEqual(self.sent(), [])
+        self.client.flush()
+        self.assertEqual(self.sent(), ['a:1|c\nb:2|c'])
+        self.client.flush()
+        self.assertEqual(len(self.sent()), 1)
+
+    def test_packs_up_to_maxudpsize(self):
+        for _ in range(10):
+            self.client.incr('counter')
+        self.client.flush()
+        packets = self.sent()
+        self.assertEqual(sum(packet.count('counter:1|c') for packet in packets), 10)
+        self.assertEqual(len(packets), 5)
+        for packet in packets:
+            assert len(packet) <= 32
+
+    def test_close_flushes(self):
+        sock = self.client._sock
+        self.client.timing('a', 1)
+        self.client.close()
+        self.assertEqual(sock.sendto.call_args[0][0], b'a:1.000000|ms')
+        assert sock.close.called
+
+    def test_flush_interval(self):
+        client = BatchStatsClient(flush_interval=0.01)
+        client._sock.close()
+        client._sock = Mock()
+        client.incr('a')
+        sleep(0.1)
+        client._stopped.set()
+        self.assertEqual(client._sock.sendto.call_args[0][0], b'a:1|c')
+
+    def test_close_at_exit(self):
+        lines = run_and_receive(
+            'from django_statsd.clients import statsd\nstatsd.incr("plain")',
+            STATSD_CLIENT='django_statsd.clients.batch',
+        )
+        self.assertEqual(lines, ['plain:1|c'])
+
+    def test_histograms_at_exit(self):
+        for client in ('django_statsd.clients.batch', 'django_statsd.clients.threaded', 'statsd.client'):
+            lines = run_and_receive(
+                'from django_statsd.clients import statsd\nstatsd.timing("view.index", 3.2)\nstatsd.incr("plain")',
+                STATSD_CLIENT=client,
+                STATSD_HISTOGRAMS={'view.*': None},
+            )
+            self.assertEqual(
+                sorted(lines),
+                ['plain:1|c', 'view.index.bucket.4:1|c', 'view.index.count:1|c', 'view.index.sum:3.2|c'],
+                client,
+            )
+
+    @override_settings(
+        STATSD_CLIENT='django_statsd.clients.batch', STATSD_CLIENT_OPTIONS={'maxudpsize': 1432, 'flush_interval': 0}
+    )
+    def test_proxy_options(self):
+        statsd = StatsdClientProxy()
+        statsd.incr('a')
+        self.assertEqual(statsd._client._maxudpsize, 1432)
+        statsd._client._sock = Mock()
+        statsd.flush()
+        assert statsd._client._sock.sendto.called
+
+
+class TestThreadedClient(TestCase):
+    def make_client(self, **kwargs):
+        client = ThreadedStatsClient(flush_interval=60, **kwargs)
+        client._sock.close()
+        client._sock = Mock()
+        return client
+
+    def sent(self, client):
+        packets = [args[0].decode() for args, kwargs in client._sock.sendto.call_args_list]
+        return [line for packet in packets for line in packet.split('\n')]
+
+    def test_no_loss_below_capacity(self):
+        client = self.make_client(queue_size=1000)
+        threads = [threading.Thread(target=lambda: [client.incr('test') for _ in range(100)]) for _ in range(9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not client._sock.sendto.called
+        client.close()
+        self.assertEqual(self.sent(client), ['test:1|c'] * 900)
+        self.assertEqual(client.dropped, 0)
+
+    def test_dropped_concurrently(self):
+        client = self.make_client(queue_size=100)
+        interval = sys.getswitchinterval()
+        # Switch threads as often as possible, so they interleave within the count.
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=lambda: [client.incr('test') for _ in range(5000)]) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        # Every metric is either queued or counted as dropped.
+        self.assertEqual(client.dropped + len(client._queue), 40000)
+        client.close()
+
+    def test_drop_newest(self):
+        client = self.make_client(queue_size=5)
+        for i in range(8):
+            client.incr(f'test.{i}')
+        client.close()
+        self.assertEqual(client.dropped, 3)
+        self.assertEqual(self.sent(client), ['statsd.queue.dropped:3|c'] + [f'test.{i}:1|c' for i in range(5)])
+
+    def test_drop_oldest(self):
+        client = self.make_client(queue_size=5, drop_policy='drop-oldest')
+        for i in range(8):
+            client.incr(f'test.{i}')
+        client.close()
+        self.assertEqual(client.dropped, 3)
+        self.assertEqual(self.sent(client), ['statsd.queue.dropped:3|c'] + [f'test.{i}:1|c' for i in range(3, 8)])
+
+    def test_flush_wakes_sender(self):
+        client = self.make_client()
+        client.incr('test')
+        client.flush()
+        for _ in range(100):
+            if client._sock.sendto.called:
+                break
+            sleep(0.01)
+        self.assertEqual(self.sent(client), ['test:1|c'])
+        client.close()
+
+    def test_close_on_event_loop(self):
+        client = self.make_client()
+        client.incr('test')
+
+        async def close():
+            client.close()
+
+        with patch.object(client._thread, 'join') as join:
+            asyncio.run(close())
+        join.assert_not_called()
+        client._thread.join(1)
+        self.assertEqual(self.sent(client), ['test:1|c'])
+        client._sock.close.assert_called_once_with()
+
+    def test_invalid_drop_policy(self):
+        with raises(ValueError):
+            ThreadedStatsClient(drop_policy='drop-everything')
+
+
+class TestAsyncioClient(TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1)
+        self.client = AsyncioStatsClient(host='127.0.0.1', port=self.receiver.getsockname()[1])
+
+    def tearDown(self):
+        self.client.close()
+        self.receiver.close()
+
+    def received(self, count):
+        return [self.receiver.recv(512).decode() for _ in range(count)]
+
+    def test_without_loop(self):
+        self.client.incr('sync')
+        self.assertEqual(self.received(1), ['sync:1|c'])
+
+    def test_sends_through_transport(self):
+        async def send():
+            self.client.incr('first')
+            await asyncio.sleep(0.01)
+            with patch.object(UDPStatsClient, '_send') as send_mock:
+                self.client.incr('second')
+            assert not send_mock.called
+            assert self.client._transports[asyncio.get_running_loop()] is not None
+            self.client.close()
+            await asyncio.sleep(0)
+
+        asyncio.run(send())
+        self.assertEqual(self.received(2), ['first:1|c', 'second:1|c'])
+
+
+class TestAsyncMiddleware(TestCase):
+    def setUp(self):
+        self.req = RequestFactory().get('/')
+        self.res = HttpResponse()
+
+        async def get_response(request):
+            return self.res
+
+        self.get_response = get_response
+
+    def test_async_capable(self):
+        for middleware_class in [middleware.GraphiteMiddleware, middleware.GraphiteRequestTimingMiddleware]:
+            self.assertEqual(middleware_class.async_capable, True)
+            self.assertEqual(middleware_class.sync_capable, True)
+            assert iscoroutinefunction(middleware_class(self.get_response))
+            assert not iscoroutinefunction(middleware_class(lambda x: x))
+
+    def test_request_timing(self):
+        func = lambda x: x  # noqa: E731
+        gmw = middleware.GraphiteRequestTimingMiddleware(self.get_response)
+        assert iscoroutinefunction(gmw.process_view)
+
+        async def handle():
+            await gmw.process_view(self.req, func, tuple(), dict())
+            return await gmw(self.req)
+
+        with (
+            patch('django_statsd.middleware.statsd') as statsd_mock,
+            patch('django.utils.deprecation.sync_to_async', side_effect=AssertionError),
+        ):
+            response = asyncio.run(handle())
+        self.assertEqual(response, self.res)
+        self.assertEqual(statsd_mock.timing.call_count, 3)
+        self.assertEqual(statsd_mock.timing.call_args_list[0][0][0], f'view.{func.__module__}.{func.__name__}.GET')
+
+    def test_graphite_response(self):
+        gmw = middleware.GraphiteMiddleware(self.get_response)
+        with (
+            patch('django_statsd.middleware.statsd') as statsd_mock,
+            patch('django.utils.deprecation.sync_to_async', side_effect=AssertionError),
+        ):
+            asyncio.run(gmw(self.req))
+        statsd_mock.incr.assert_called_once_with('response.200')
+
+    def test_graphite_response_lazy_user(self):
+        user = Mock(is_authenticated=True)
+        self.req.user = SimpleLazyObject(lambda: user)
+        gmw = middleware.GraphiteMiddleware(self.get_response)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            asyncio.run(gmw(self.req))
+        self.assertEqual(statsd_mock.incr.call_count, 2)
+
+
+class TestAggregation(TestCase):
+    def tearDown(self):
+        aggregation.deactivate()
+
+    def test_counters(self):
+        aggregator = aggregation.RequestAggregator()
+        for _ in range(200):
+            aggregator.incr('db.select')
+        aggregator.incr('cache.hit', 3)
+        aggregator.decr('cache.hit')
+        client = Mock()
+        aggregator.flush(client)
+        self.assertEqual(client.incr.call_args_list, [(('db.select', 200),), (('cache.hit', 2),)])
+        assert 'timing' not in aggregator.methods
+
+    def test_timers(self):
+        aggregator = aggregation.RequestAggregator(timers=True)
+        aggregator.timing('db.select', 2)
+        aggregator.timing('db.select', 5)
+        aggregator.timing('db.select', 1)
+        with aggregator.timer('db.update'):
+            pass
+        client = Mock()
+        aggregator.flush(client)
+        self.assertEqual(client.incr.call_args_list, [(('db.select.count', 3),), (('db.update.count', 1),)])
+        self.assertEqual(client.timing.call_args_list[:2], [(('db.select.sum', 8),), (('db.select.max', 5),)])
+
+    @override_settings(STATSD_CLIENT='django_statsd.clients.toolbar')
+    def test_proxy_routes_to_aggregator(self):
+        statsd = StatsdClientProxy()
+        aggregator = aggregation.activate()
+        for _ in range(3):
+            statsd.incr('testing')
+        statsd.timing('testing', 1)
+        self.assertEqual(statsd.cache, {})
+        self.assertEqual(len(statsd.timings), 1)
+        aggregation.deactivate()
+        aggregator.flush(statsd)
+        self.assertEqual(statsd.cache, {'testing|count': [[3, 1]]})
+
+    @override_settings(STATSD_AGGREGATE=True)
+    def test_middleware(self):
+        req = RequestFactory().get('/')
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        with patch('django_statsd.middleware.statsd') as statsd_mock:
+            gmw.process_request(req)
+            for _ in range(5):
+                proxy_statsd.incr('db.select')
+            gmw.process_response(req, HttpResponse())
+        statsd_mock.incr.assert_called_once_with('db.select', 5)
+        self.assertEqual(aggregation.get_aggregator(), None)
+
+    def test_middleware_disabled(self):
+        req = RequestFactory().get('/')
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        gmw.process_request(req)
+        self.assertEqual(aggregation.get_aggregator(), None)
+
+
+class TestClientRefreshThreads(TestCase):
+    @override_settings(STATSD_REFRESH_SECONDS=0)
+    def test_concurrent_refresh(self):
+        lock = threading.Lock()
+        sockets = []
+        building = []
+        max_building = []
+
+        class TrackedStatsClient(UDPStatsClient):
+            def __init__(self, *args, **kwargs):
+                with lock:
+                    building.append(self)
+                    max_building.append(len(building))
+                sleep(0.001)
+                super().__init__(*args, **kwargs)
+                with lock:
+                    sockets.append(self._sock)
+                    building.remove(self)
+
+        statsd = StatsdClientProxy()
+
+        def hammer():
+            for _ in range(200):
+                statsd.incr('test')
+
+        with patch('django_statsd.clients.import_module', return_value=Mock(StatsClient=TrackedStatsClient)):
+            threads = [threading.Thread(target=hammer) for _ in range(16)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert len(sockets) > 2
+        self.assertEqual(max(max_building), 1)
+        open_sockets = [sock for sock in sockets if sock.fileno() != -1]
+        self.assertEqual(open_sockets, sockets[-2:])
+        for sock in open_sockets:
+            sock.close()
+
+    @override_settings(STATSD_CLIENT='django_statsd.clients.toolbar')
+    def test_refresh_on_event_loop(self):
+        statsd = StatsdClientProxy()
+        statsd.incr('test')
+        old_client = statsd._client
+        built_in = []
+        rebuild = statsd._rebuild
+
+        def slow_rebuild():
+            sleep(0.05)
+            built_in.append(threading.current_thread().name)
+            rebuild()
+
+        async def send():
+            statsd.incr('test')
+            # The loop isn't blocked by the rebuild, and keeps sending through the old client.
+            return statsd._client
+
+        with patch.object(statsd, '_rebuild', slow_rebuild):
+            statsd._expires_at = 0.0
+            self.assertIs(asyncio.run(send()), old_client)
+            for _ in range(100):
+                if statsd._client is not old_client:
+                    break
+                sleep(0.01)
+        self.assertEqual(built_in, ['statsd-refresh'])
+        self.assertIsNot(statsd._client, old_client)
+        assert not statsd._lock.locked()
+
+
+class TestHostResolver(TestCase):
+    def setUp(self):
+        self.client = Mock(_addr=('10.0.0.1', 8125))
+        self.addresses = [('10.0.0.1', 8125)]
+
+    def fake_resolve(self, host, port, family):
+        address = self.addresses.pop(0)
+        if address is None:
+            raise OSError('Name or service not known')
+        return address
+
+    def test_unchanged_address(self):
+        resolver = HostResolver(self.client, 'statsd', 8125, 120, resolve=self.fake_resolve)
+        resolver.resolve_once()
+        self.assertEqual(self.client._addr, ('10.0.0.1', 8125))
+        self.assertEqual(self.client.timing.call_args[0][0], 'statsd.resolve.time')
+        assert not self.client.incr.called
+
+    def test_changed_address(self):
+        self.addresses = [('10.0.0.2', 8125)]
+        resolver = HostResolver(self.client, 'statsd', 8125, 120, resolve=self.fake_resolve)
+        resolver.resolve_once()
+        self.assertEqual(self.client._addr, ('10.0.0.2', 8125))
+        self.client.incr.assert_called_once_with('statsd.resolve.changed')
+
+    def test_failure_keeps_address(self):
+        self.addresses = [None]
+        resolver = HostResolver(self.client, 'statsd', 8125, 120, resolve=self.fake_resolve)
+        resolver.resolve_once()
+        self.assertEqual(self.client._addr, ('10.0.0.1', 8125))
+        self.client.incr.assert_called_once_with('statsd.resolve.failure')
+        assert not self.client.timing.called
+
+    @override_settings(STATSD_CLIENT='statsd.client', STATSD_BACKGROUND_RESOLVE=True)
+    def test_proxy_keeps_client(self):
+        statsd = StatsdClientProxy()
+        with patch.object(HostResolver, 'start') as start_mock:
+            statsd.incr('test')
+        assert start_mock.called
+        self.assertEqual(statsd._expires_at, float('inf'))
+        self.assertEqual(statsd._resolver.client, statsd._client)
+        self.assertEqual(statsd._resolver.family, socket.AF_INET)
+        statsd._client._sock.close()
+
+    def test_ipv6(self):
+        self.assertEqual(resolve('::1', 8125, socket.AF_INET6)[:2], ('::1', 8125))
+        with override_settings(
+            STATSD_CLIENT='statsd.client',
+            STATSD_HOST='::1',
+            STATSD_CLIENT_OPTIONS={'ipv6': True},
+            STATSD_BACKGROUND_RESOLVE=True,
+        ):
+            statsd = StatsdClientProxy()
+            with patch.object(HostResolver, 'start'):
+                statsd.incr('test')
+        resolver = statsd._resolver
+        self.assertEqual(resolver.family, socket.AF_INET6)
+        self.client._addr = statsd._client._addr
+        resolver.client = self.client
+        resolver.resolve_once()
+        self.client.incr.assert_not_called()
+        statsd._client._sock.close()
+
+
+class TestTaskStartTimes(TestCase):
+    def test_orphaned_tasks_max_size(self):
+        start_times = TaskStartTimes(max_size=1000)
+        evicted = sum(start_times.start(f'orphan-{i}', i) for i in range(5000))
+        self.assertEqual(len(start_times), 1000)
+        self.assertEqual(evicted, 4000)
+        self.assertEqual(start_times.stop('orphan-0'), None)
+        self.assertEqual(start_times.stop('orphan-4999'), 4999)
+
+    def test_orphaned_tasks_ttl(self):
+        second = 10**9
+        start_times = TaskStartTimes(ttl=60)
+        for i in range(3000):
+            start_times.start(f'orphan-{i}', 0)
+        start_times.start('running', 30 * second)
+        self.assertEqual(len(start_times), 3001)
+        self.assertEqual(start_times.start('new', 61 * second), 3000)
+        self.assertEqual(len(start_times), 2)
+        self.assertEqual(start_times.stop('running'), 30 * second)
+
+    def test_restarted_task(self):
+        start_times = TaskStartTimes(max_size=2)
+        start_times.start('a', 1)
+        start_times.start('b', 2)
+        start_times.start('a', 3)
+        start_times.start('c', 4)
+        self.assertEqual(start_times.stop('a'), 3)
+        self.assertEqual(start_times.stop('b'), None)
+
+
+class TestTaskKeyRegistry(TestCase):
+    def test_default_template(self):
+        registry = TaskKeyRegistry()
+        keys = registry.get('myapp.tasks.add', 'default')
+        self.assertEqual(keys.start, 'celery.myapp_tasks_add.start')
+        self.assertEqual(keys.queue_wait, 'celery.myapp_tasks_add.queue_wait')
+        # The keys don't depend on the queue, so they are shared.
+        assert registry.get('myapp.tasks.add', 'low') is keys
+        self.assertEqual(len(registry), 1)
+
+    def test_queue_prefixes(self):
+        registry = TaskKeyRegistry('{prefix}celery.{task}.{event}', queue_prefixes={'high.priority': 'high.'})
+        self.assertEqual(registry.get('add', 'high.priority').done, 'high.celery.add.done')
+        self.assertEqual(registry.get('add', 'default').done, 'celery.add.done')
+        self.assertEqual(registry.get('add').done, 'celery.add.done')
+
+    def test_queue_template(self):
+        registry = TaskKeyRegistry('celery.{queue}.{task}.{event}')
+        self.assertEqual(registry.get('add', 'high.priority').retry, 'celery.high_priority.add.retry')
+        self.assertEqual(registry.get('add').retry, 'celery.unknown.add.retry')
+
+    def test_tagged(self):
+        registry = TaskKeyRegistry(tagged=True)
+        self.assertEqual(registry.get('myapp.tasks.add', 'default').start, 'celery.start;task=myapp.tasks.add')
+        registry = TaskKeyRegistry('celery.{queue}.{task}.{event}', tagged=True)
+        self.assertEqual(registry.get('add', 'high.priority').retry, 'celery.retry;task=add;queue=high.priority')
+        self.assertEqual(registry.get('add').retry, 'celery.retry;task=add;queue=unknown')
+
+    def test_preload(self):
+        registry = TaskKeyRegistry('celery.{queue}.{task}.{event}')
+        registry.preload(['add', 'mul'], ['default', 'low'])
+        self.assertEqual(len(registry), 4)
+        with patch.object(registry, 'build') as build:
+            registry.get('mul', 'low')
+        build.assert_not_called()
+
+    def test_signals(self):
+        registry = TaskKeyRegistry('{prefix}celery.{task}.{event}', queue_prefixes={'high': 'high.'})
+        task = Mock(request=Mock(delivery_info={'routing_key': 'high'}, statsd_published_at=None, headers=None))
+        task.name = 'tests.add'
+        with (
+            patch('django_statsd.celery_hooks.task_key_registry', registry),
+            patch('django_statsd.celery_hooks.statsd') as statsd_mock,
+        ):
+            celery_signals.before_task_publish.send(sender='tests.add', routing_key='high')
+            celery_signals.task_prerun.send(sender=task, task_id='keys')
+            celery_signals.task_postrun.send(sender=task, task_id='keys')
+        self.assertEqual(
+            [args[0] for args, kwargs in statsd_mock.incr.call_args_list],
+            ['high.celery.tests_add.before_task_publish', 'high.celery.tests_add.start', 'high.celery.tests_add.done'],
+        )
+        self.assertEqual(statsd_mock.timing.call_args[0][0], 'high.celery.tests_add.runtime')
+
+
+class TestWorkerStats(TestCase):
+    def setUp(self):
+        self.stats = WorkerStats()
+        self.node = self.stats.node
+
+    def task(self, queue):
+        return Mock(request=Mock(delivery_info={'routing_key': queue}))
+
+    def test_node(self):
+        # Outside of a pool the process has no index. The pid isn't used, so the keys survive a recycled process.
+        self.assertEqual(self.node, f'{self.stats.hostname}.main')
+        with patch('billiard.process.current_process', return_value=Mock(index=3)):
+            self.stats.reset()
+        self.assertEqual(self.stats.node, f'{self.stats.hostname}.3')
+
+    def test_forked_while_flushing(self):
+        # The flush thread of the parent holds the lock when the pool process is forked.
+        self.stats._lock.acquire()
+        with patch.object(WorkerStats, 'start'):
+            self.stats.on_worker_process_init()
+        assert not self.stats._lock.locked()
+        self.stats.on_task_prerun(sender=self.task('default'))
+        self.assertEqual(self.stats._active['default'], 1)
+
+    def test_flush(self):
+        self.stats.on_task_prerun(sender=self.task('default'))
+        self.stats.on_task_prerun(sender=self.task('default'))
+        self.stats.on_task_prerun(sender=self.task('high.priority'))
+        self.stats.on_task_postrun(sender=self.task('default'))
+        with patch('django_statsd.celery_hooks.statsd') as statsd_mock:
+            self.stats.flush()
+        self.assertCountEqual(
+            statsd_mock.gauge.call_args_list,
+            [
+                ((f'celery.queue.default.active.{self.node}', 1),),
+                ((f'celery.queue.high_priority.active.{self.node}', 1),),
+                ((f'celery.worker.{self.node}.active', 2),),
+            ],
+        )
+        self.assertCountEqual(
+            statsd_mock.incr.call_args_list,
+            [(('celery.queue.default.executed', 1),), ((f'celery.worker.{self.node}.executed', 1),)],
+        )
+
+    def test_flush_sends_absolute_gauges(self):
+        self.stats.on_task_prerun(sender=self.task('default'))
+        with patch('django_statsd.celery_hooks.statsd'):
+            self.stats.flush()
+        self.stats.on_task_postrun(sender=self.task('default'))
+        with patch('django_statsd.celery_hooks.statsd') as statsd_mock:
+            self.stats.flush()
+            self.stats.flush()
+        self.assertEqual(
+            statsd_mock.gauge.call_args_list,
+            [
+                ((f'celery.queue.default.active.{self.node}', 0),),
+                ((f'celery.worker.{self.node}.active', 0),),
+            ]
+            * 2,
+        )
+        self.assertEqual(statsd_mock.incr.call_count, 2)
+
+    def test_prefetched(self):
+        active = self.task('default').request
+        reserved = [active, self.task('default').request, self.task('low').request]
+        self.stats.reset(consumer=True)
+        with (
+            patch('celery.worker.state.reserved_requests', set(reserved)),
+            patch('celery.worker.state.active_requests', {active}),
+            patch('django_statsd.celery_hooks.statsd') as statsd_mock,
+        ):
+            self.stats.flush()
+        gauges = statsd_mock.gauge.call_args_list
+        hostname = self.stats.hostname
+        assert ((f'celery.queue.default.prefetched.{hostname}', 1),) in gauges
+        assert ((f'celery.queue.low.prefetched.{hostname}', 1),) in gauges
+        assert ((f'celery.worker.{hostname}.prefetched', 2),) in gauges
+
+    def test_shutdown(self):
+        self.stats.reset(consumer=True)
+        self.stats.on_task_prerun(sender=self.task('default'))
+        with (
+            patch('celery.worker.state.reserved_requests', {self.task('low').request}),
+            patch('celery.worker.state.active_requests', set()),
+            patch('django_statsd.celery_hooks.statsd'),
+        ):
+            self.stats.flush()
+        with patch('django_statsd.celery_hooks.statsd') as statsd_mock:
+            self.stats.on_worker_shutdown()
+        self.assertCountEqual(
+            [args for args, kwargs in statsd_mock.gauge.call_args_list],
+            [
+                (f'celery.queue.default.active.{self.stats.node}', 0),
+                (f'celery.worker.{self.stats.node}.active', 0),
+                (f'celery.queue.low.prefetched.{self.stats.hostname}', 0),
+                (f'celery.worker.{self.stats.hostname}.prefetched', 0),
+            ],
+        )
+
 
 class TestSignals(DjangoTestCase):
     def setUp(self):
@@ -336,6 +1476,54 @@ class TestSignals(DjangoTestCase):
         self.assertEqual(statsd_mock.incr.call_count, 8)
         self.assertEqual(statsd_mock.timing.call_count, 1)
 
+    def test_celery_tracked_tasks_gauge(self):
+        with patch('django_statsd.celery_hooks.statsd') as statsd_mock:
+            celery_signals.task_prerun.send(sender=self.sender, task_id='gauge')
+            tracked = statsd_mock.gauge.call_args[0][1]
+            celery_signals.task_postrun.send(sender=self.sender, task_id='gauge')
+        self.assertEqual(statsd_mock.gauge.call_args[0][0], 'celery.tracked_tasks')
+        assert tracked >= 1
+
+    def test_celery_publish_stamps_header(self):
+        app = Celery('test_publish', broker='memory://', set_as_current=False)
+        task = app.task(name='tests.add')(add)
+        with patch('django_statsd.celery_hooks.statsd'):
+            task.delay(1, 2)
+        with app.connection() as connection:
+            queue = connection.SimpleQueue('celery')
+            message = queue.get(timeout=1)
+            queue.close()
+        published_at = message.headers[PUBLISHED_AT_HEADER]
+        assert 0 <= time() - published_at < 10
+
+    def test_celery_queue_wait(self):
+        app = Celery('test_queue_wait', set_as_current=False)
+        app.conf.task_always_eager = True
+        task = app.task(name='tests.add')(add)
+        with patch('django_statsd.celery_hooks.statsd') as statsd_mock:
+            task.apply_async((1, 2), headers={PUBLISHED_AT_HEADER: time() - 2})
+        timings = {args[0]: args[1] for args, kwargs in statsd_mock.timing.call_args_list}
+        assert 2000 <= timings['celery.tests_add.queue_wait'] < 3000
+        assert timings['celery.tests_add.end_to_end'] >= timings['celery.tests_add.queue_wait']
+
+    def test_celery_queue_wait_clock_skew(self):
+        task = Mock(request=Mock(statsd_published_at=time() + 60))
+        task.name = 'testing'
+        with patch('django_statsd.celery_hooks.statsd') as statsd_mock:
+            celery_signals.task_prerun.send(sender=task, task_id='skewed')
+        statsd_mock.timing.assert_called_once_with('celery.testing.queue_wait', 0.0)
+
+    def test_celery_runtime_clock_jump(self):
+        with (
+            patch('django_statsd.celery_hooks.statsd') as statsd_mock,
+            patch('time.time', side_effect=[1e9, 0, -1e9, 2e9]),
+        ):
+            celery_signals.task_prerun.send(sender=self.sender, task_id='1')
+            celery_signals.task_postrun.send(sender=self.sender, task_id='1')
+        ms = statsd_mock.timing.call_args[0][1]
+        assert isinstance(ms, float)
+        assert 0 <= ms < 1000
+
     def test_auth_signals(self):
         req = RequestFactory().get('/')
         user = Mock()
@@ -643,6 +1831,217 @@ class TestCacheWrappingPatching(DjangoTestCase):
         self.assertEqual(value, 1)
         assert cache.default_timeout == 300
 
+    def test_patched_caches(self):
+        cache_patch()
+        cache_patch()
+        assert isinstance(caches['default'], CacheTracker)
+        assert isinstance(caches['default'].cache, LocMemCache)
+        tracked = []
+        thread = threading.Thread(target=lambda: tracked.append(caches['default']))
+        thread.start()
+        thread.join()
+        assert isinstance(tracked[0], CacheTracker)
+        assert isinstance(tracked[0].cache, LocMemCache)
+
+    def test_cache_tracker(self):
+        cache = CacheTracker(caches['default'], 'default')
+        with patch('django_statsd.patches.cache.statsd') as statsd_mock:
+            cache.set('A', 1)
+            self.assertEqual(cache.get('A'), 1)
+            self.assertEqual(asyncio.run(cache.aget('A')), 1)
+        self.assertEqual(
+            [args[0] for args, kwargs in statsd_mock.timing.call_args_list],
+            ['cache.locmem.set', 'cache.locmem.get', 'cache.locmem.get'],
+        )
+        assert cache.default_timeout == 300
+        # Attributes that are not timed are looked up on the backend.
+        self.assertEqual(cache.make_key('A'), caches['default'].make_key('A'))
+
+    def test_cache_tracker_basecache(self):
+        backend = LocMemCache('base', {'KEY_PREFIX': 'prefix'})
+        cache = CacheTracker(backend, 'default')
+        assert isinstance(cache, BaseCache)
+        # The methods of BaseCache are the ones of the backend.
+        self.assertEqual(cache.make_key('A'), 'prefix:1:A')
+        with patch.object(backend, 'close') as close:
+            cache = CacheTracker(backend, 'default')
+            cache.close()
+        close.assert_called_once_with()
+
+    @override_settings(
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'other': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        }
+    )
+    def test_patch_creates_no_caches(self):
+        created = []
+
+        def create_connection(alias):
+            created.append(alias)
+            return LocMemCache(alias, {})
+
+        with patch.object(caches, 'create_connection', create_connection):
+            backend = caches['default']
+            cache_patch()
+            assert isinstance(caches['default'], CacheTracker)
+            assert caches['default'].cache is backend
+            self.assertEqual(created, ['default'])
+            # The other cache is tracked when it is created.
+            assert isinstance(caches['other'], CacheTracker)
+
+
+class TestCacheHits(TestCase):
+    def setUp(self):
+        self.cache = CacheTracker(LocMemCache('hits', {}), 'default')
+        self.cache.clear()
+        self.cache.set('a', 1)
+        self.cache.set('none', None)
+
+    def counts(self, statsd_mock):
+        return [args for args, kwargs in statsd_mock.incr.call_args_list]
+
+    def test_get(self):
+        with patch('django_statsd.patches.cache.statsd') as statsd_mock:
+            self.assertEqual(self.cache.get('a'), 1)
+            self.assertEqual(self.cache.get('none', 'default'), None)
+            self.assertEqual(self.cache.get('b', 'default'), 'default')
+        self.assertEqual(
+            self.counts(statsd_mock),
+            [('cache.default.hits', 1), ('cache.default.hits', 1), ('cache.default.misses', 1)],
+        )
+
+    def test_get_many(self):
+        with patch('django_statsd.patches.cache.statsd') as statsd_mock:
+            self.assertEqual(self.cache.get_many(iter(['a', 'b', 'c'])), {'a': 1})
+        self.assertEqual(self.counts(statsd_mock), [('cache.default.hits', 1), ('cache.default.misses', 2)])
+
+    def test_get_or_set(self):
+        with patch('django_statsd.patches.cache.statsd') as statsd_mock:
+            self.assertEqual(self.cache.get_or_set('a', 2), 1)
+            self.assertEqual(self.cache.get_or_set('b', lambda: 2), 2)
+            self.assertEqual(self.cache.get_or_set('b', 3), 2)
+        self.assertEqual(
+            self.counts(statsd_mock),
+            [('cache.default.hits', 1), ('cache.default.misses', 1), ('cache.default.hits', 1)],
+        )
+
+    def test_has_key(self):
+        with patch('django_statsd.patches.cache.statsd') as statsd_mock:
+            assert self.cache.has_key('a')
+            assert not self.cache.has_key('b')
+        self.assertEqual(self.counts(statsd_mock), [('cache.default.hits', 1), ('cache.default.misses', 1)])
+
+    def test_async(self):
+        async def run():
+            return (
+                await self.cache.aget('a'),
+                await self.cache.aget_many(['a', 'b']),
+                await self.cache.aget_or_set('c', 3),
+                await self.cache.ahas_key('c'),
+            )
+
+        hits = aggregation.count_cache_hits()
+        try:
+            with patch('django_statsd.patches.cache.statsd'):
+                self.assertEqual(asyncio.run(run()), (1, {'a': 1}, 3, True))
+        finally:
+            aggregation.stop_counting_cache_hits()
+        self.assertEqual((dict(hits.hits), dict(hits.misses)), ({'default': 3}, {'default': 2}))
+
+    def test_summed_per_request(self):
+        gmw = middleware.GraphiteRequestTimingMiddleware(lambda x: x)
+        request = RequestFactory().get('/')
+        with (
+            patch('django_statsd.patches.cache.statsd') as cache_statsd_mock,
+            patch('django_statsd.middleware.statsd') as statsd_mock,
+        ):
+            gmw.process_request(request)
+            for _ in range(3):
+                self.cache.get('a')
+                self.cache.get('b')
+            self.cache.get_many(['a', 'b', 'c'])
+            gmw.process_response(request, HttpResponse())
+        cache_statsd_mock.incr.assert_not_called()
+        self.assertEqual(
+            self.counts(statsd_mock),
+            [('cache.default.hits', 4), ('cache.default.misses', 5)],
+        )
+
+
+class TestCachePayloadSizes(TestCase):
+    def tracker(self, rate=1, backend=None):
+        with (
+            patch('django_statsd.patches.cache.PAYLOAD_SIZES', True),
+            patch('django_statsd.patches.cache.PAYLOAD_SAMPLE_RATE', rate),
+        ):
+            cache = CacheTracker(backend or LocMemCache('sizes', {}), 'default')
+        cache.clear()
+        return cache
+
+    def sizes(self, statsd_mock):
+        return [args for args, kwargs in statsd_mock.timing.call_args_list if args[0].endswith('.bytes')]
+
+    def test_set_and_get(self):
+        cache = self.tracker()
+        value = 'x' * 1000
+        with patch('django_statsd.patches.cache.statsd') as statsd_mock:
+            cache.set('a', value)
+            cache.set_many({'b': 1, 'c': [value, value]})
+            self.assertEqual(cache.get('a'), value)
+            cache.get('missing')
+            self.assertEqual(cache.get_many(['b']), {'b': 1})
+        self.assertEqual(
+            self.sizes(statsd_mock),
+            [
+                ('cache.default.set.bytes', measure(value), 1),
+                ('cache.default.set.bytes', measure(1), 1),
+                ('cache.default.set.bytes', measure([value, value]), 1),
+                ('cache.default.get.bytes', measure(value), 1),
+                ('cache.default.get.bytes', measure(1), 1),
+            ],
+        )
+        assert ('cache.default.set.serialize',) in [args[:1] for args, kwargs in statsd_mock.timing.call_args_list]
+
+    @override_settings(STATSD_CLIENT='statsd.client')
+    def test_sampled(self):
+        cache = self.tracker(rate=0.5)
+        statsd = StatsdClientProxy()
+        # Only the sampling of the values draws a random number, the client doesn't sample them again.
+        with (
+            patch('django_statsd.patches.cache.statsd', statsd),
+            patch.object(UDPStatsClient, '_send') as send,
+            patch('django_statsd.patches.cache.measure', return_value=10) as measure_mock,
+            patch('random.random', side_effect=[0.1, 0.9]),
+        ):
+            cache.set('a', 1)
+            cache.set('b', 2)
+        measure_mock.assert_called_once_with(1)
+        sent = [args[0] for args, kwargs in send.call_args_list if '.set.' in args[0]]
+        self.assertEqual(len(sent), 2)
+        assert sent[0].startswith('cache.default.set.serialize:')
+        self.assertEqual(sent[1], 'cache.default.set.bytes:10.000000|ms')
+
+    def test_unpicklable(self):
+        cache = self.tracker(backend=DummyCache('sizes', {}))
+        with patch('django_statsd.patches.cache.statsd') as statsd_mock:
+            cache.set('a', lambda: 1)
+            cache.set_many({'b': threading.Lock(), 'c': 1})
+        self.assertEqual(self.sizes(statsd_mock), [('cache.default.set.bytes', measure(1), 1)])
+
+    def test_disabled(self):
+        cache = CacheTracker(LocMemCache('sizes', {}), 'default')
+        with (
+            patch('django_statsd.patches.cache.statsd') as statsd_mock,
+            patch('django_statsd.patches.cache.measure') as measure_mock,
+        ):
+            cache.set('a', 1)
+            cache.get('a')
+        measure_mock.assert_not_called()
+        self.assertEqual(self.sizes(statsd_mock), [])
+        # The set of the backend is timed directly.
+        assert 'set' in vars(cache)
+
 
 class TestCursorWrapperPatching(DjangoTestCase):
     example_queries = {
@@ -685,6 +2084,22 @@ class TestCursorWrapperPatching(DjangoTestCase):
                     f'db.client_executable_name.alias.execute.{operation}',
                 )
 
+    def test_request_stats_only(self):
+        db = Mock(alias='alias', client=Mock(executable_name='client_executable_name'))
+        with (
+            patch('django_statsd.patches.db.statsd') as statsd_mock,
+            patch('django_statsd.patches.db.REQUEST_STATS_ONLY', True),
+        ):
+            aggregation.count_queries()
+            try:
+                patched_execute(lambda *args, **kwargs: None, Mock(db=db), 'select 1')
+            finally:
+                aggregation.stop_counting_queries()
+            patched_execute(lambda *args, **kwargs: None, Mock(db=db), 'select 2')
+        timer = statsd_mock.timer.return_value
+        self.assertEqual(timer.stop.call_args_list, [((), {'send': False})] * 2)
+        timer.send.assert_called_once_with()
+
     def test_patched_executemany_calls_timer(self):
         for operation, query in list(self.example_queries.items()):
             with patch('django_statsd.patches.db.statsd') as statsd_mock:
@@ -699,3 +2114,234 @@ class TestCursorWrapperPatching(DjangoTestCase):
                     statsd_mock.timer.call_args[0][0],
                     f'db.client_executable_name.alias.executemany.{operation}',
                 )
+
+
+class TestExecuteWrapper(DjangoTestCase):
+    def setUp(self):
+        db_wrapper.install(connection)
+
+    def tearDown(self):
+        connection.execute_wrappers[:] = [
+            wrapper
+            for wrapper in connection.execute_wrappers
+            if not isinstance(wrapper, db_wrapper.StatsdExecuteWrapper)
+        ]
+
+    def test_execute(self):
+        with patch('django_statsd.patches.db_wrapper.statsd') as statsd_mock, connection.cursor() as cursor:
+            cursor.execute('  CREATE TEMPORARY TABLE statsd_test (a integer)')
+            cursor.executemany('insert into statsd_test values (%s)', [(1,), (2,)])
+            cursor.execute('SELECT * FROM statsd_test')
+        self.assertEqual(
+            [args[0] for args, kwargs in statsd_mock.timing.call_args_list],
+            [
+                'db.sqlite3.default.execute.create',
+                'db.sqlite3.default.executemany.insert',
+                'db.sqlite3.default.execute.select',
+            ],
+        )
+
+    def test_counts_queries(self):
+        # Other tests patch the CursorWrapper for good, which would count the queries as well.
+        wrapper = db_wrapper.StatsdExecuteWrapper(connection)
+        execute = Mock()
+        stats = aggregation.count_queries()
+        try:
+            with patch('django_statsd.patches.db_wrapper.statsd'):
+                wrapper(execute, 'SELECT 1', None, False, {})
+                wrapper(execute, 'select 2', None, False, {})
+        finally:
+            aggregation.stop_counting_queries()
+        self.assertEqual(dict(stats.types), {'select': 2})
+        self.assertEqual(stats.count, 2)
+        assert stats.time > 0
+
+    def test_request_stats_only(self):
+        wrapper = db_wrapper.StatsdExecuteWrapper(connection)
+        execute = Mock()
+        with (
+            patch('django_statsd.patches.db_wrapper.statsd') as statsd_mock,
+            patch('django_statsd.patches.db.REQUEST_STATS_ONLY', True),
+        ):
+            aggregation.count_queries()
+            try:
+                wrapper(execute, 'SELECT 1', None, False, {})
+            finally:
+                aggregation.stop_counting_queries()
+            # Outside of a request, the query is still timed.
+            wrapper(execute, 'SELECT 2', None, False, {})
+        statsd_mock.timing.assert_called_once()
+        self.assertEqual(statsd_mock.timing.call_args[0][0], 'db.sqlite3.default.execute.select')
+
+    def test_installed_once(self):
+        db_wrapper.install(connection)
+        db_wrapper.on_connection_created(sender=None, connection=connection)
+        wrappers = [w for w in connection.execute_wrappers if isinstance(w, db_wrapper.StatsdExecuteWrapper)]
+        self.assertEqual(len(wrappers), 1)
+
+    def test_installed_inside_execute_wrapper_block(self):
+        # The connection is only opened by the first query, inside the block of another execute wrapper.
+        new_connection = connections.create_connection('default')
+
+        def blocker(execute, sql, params, many, context):
+            return execute(sql, params, many, context)
+
+        connection_created.connect(db_wrapper.on_connection_created)
+        try:
+            with new_connection.execute_wrapper(blocker), new_connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        finally:
+            connection_created.disconnect(db_wrapper.on_connection_created)
+            new_connection.close()
+        self.assertEqual(len(new_connection.execute_wrappers), 1)
+        self.assertIsInstance(new_connection.execute_wrappers[0], db_wrapper.StatsdExecuteWrapper)
+
+    def test_keys_cached(self):
+        wrapper = db_wrapper.StatsdExecuteWrapper(connection)
+        assert wrapper.get_key('select', False) is wrapper.get_key('select', False)
+        self.assertEqual(wrapper.get_key('insert', True), 'db.sqlite3.default.executemany.insert')
+        with patch.object(db_wrapper, 'MAX_QUERY_TYPES', 2):
+            wrapper.get_key('update', False)
+        self.assertEqual(len(wrapper._keys), 2)
+
+
+class TestFingerprints(TestCase):
+    def test_normalize(self):
+        self.assertEqual(
+            normalize("SELECT * FROM  \"users\"\n WHERE id IN (1, 2, 3) AND name = 'o''neil' AND score > 1.5e3"),
+            'SELECT * FROM "users" WHERE id IN (...) AND name = ? AND score > ?',
+        )
+        self.assertEqual(
+            normalize('INSERT INTO t2 (a, b) VALUES (%s, %s), (%s, %s), (%s, %s)'),
+            'INSERT INTO t2 (a, b) VALUES (?, ?)',
+        )
+        self.assertEqual(
+            normalize('SELECT a FROM t WHERE b IN (%s,%s) LIMIT 21'), 'SELECT a FROM t WHERE b IN (...) LIMIT ?'
+        )
+
+    def test_fingerprint(self):
+        fingerprint_1, normalized = fingerprint('SELECT a FROM t WHERE b IN (%s, %s)')
+        fingerprint_2, _ = fingerprint('SELECT a FROM t WHERE b IN (%s, %s, %s)')
+        fingerprint_3, _ = fingerprint('SELECT a FROM t WHERE c = %s')
+        self.assertEqual(fingerprint_1, fingerprint_2)
+        self.assertNotEqual(fingerprint_1, fingerprint_3)
+        self.assertEqual(len(fingerprint_1), 12)
+        self.assertEqual(normalized, 'SELECT a FROM t WHERE b IN (...)')
+
+    def test_heavy_hitters(self):
+        heavy_hitters = HeavyHitters(size=2)
+        assert heavy_hitters.add('a', 10, 'A')
+        assert heavy_hitters.add('b', 5)
+        # A newcomer takes the slot of the lowest total, but has to earn its place.
+        assert not heavy_hitters.add('c', 1)
+        self.assertEqual(heavy_hitters.top(), [('a', 10, 'A'), ('c', 6, None)])
+        assert not heavy_hitters.add('c', 4)
+        assert heavy_hitters.add('c', 2)
+        assert heavy_hitters.add('a', 1)
+
+    def test_report_query(self):
+        connection = Mock(alias='default', client=Mock(executable_name='sqlite3'))
+        with (
+            patch.object(db, 'FINGERPRINTS', True),
+            patch.object(db, 'heavy_hitters', HeavyHitters(size=1)),
+            patch('django_statsd.patches.db.statsd') as statsd_mock,
+        ):
+            db.report_query(connection, 'SELECT 1', 'select', 5.0)
+            db.report_query(connection, 'UPDATE t SET a = 1', 'update', 1.0)
+        hashed, _ = fingerprint('SELECT 1')
+        self.assertEqual(
+            statsd_mock.timing.call_args_list,
+            [
+                ((f'db.sqlite3.default.fingerprint.{hashed}', 5.0),),
+                (('db.sqlite3.default.fingerprint.other', 1.0),),
+            ],
+        )
+
+
+class TestTableMetrics(TestCase):
+    def setUp(self):
+        self.connection = Mock(alias='default', client=Mock(executable_name='sqlite3'))
+
+    def test_get_table(self):
+        self.assertEqual(get_table('SELECT "auth_user"."id" FROM "auth_user" WHERE "auth_user"."id" = %s'), 'auth_user')
+        self.assertEqual(get_table('INSERT INTO `shop`.`order` (a) VALUES (%s)'), 'shop_order')
+        self.assertEqual(get_table('update Product set price = 1'), 'product')
+        self.assertEqual(get_table('DELETE FROM [dbo].[log]'), 'dbo_log')
+        self.assertEqual(get_table('SAVEPOINT "s1"'), None)
+
+    def test_table_timings(self):
+        with (
+            patch.object(db, 'TABLE_METRICS', True),
+            patch.object(db, '_seen_tables', set()),
+            patch.object(db, 'TABLE_LIMIT', 1),
+            patch('django_statsd.patches.db.statsd') as statsd_mock,
+        ):
+            db.report_query(self.connection, 'SELECT * FROM "app_a"', 'select', 1.0)
+            db.report_query(self.connection, 'SELECT * FROM "app_b"', 'select', 2.0)
+            db.report_query(self.connection, 'UPDATE "app_a" SET x = 1', 'update', 3.0)
+            db.report_query(self.connection, 'RELEASE SAVEPOINT "s1"', 'release', 4.0)
+        self.assertEqual(
+            statsd_mock.timing.call_args_list,
+            [
+                (('db.sqlite3.default.app_a.select', 1.0),),
+                (('db.sqlite3.default.other.select', 2.0),),
+                (('db.sqlite3.default.app_a.update', 3.0),),
+            ],
+        )
+
+    def test_table_whitelist(self):
+        with (
+            patch.object(db, 'TABLE_METRICS', True),
+            patch.object(db, 'TABLES', frozenset(['app_b'])),
+            patch('django_statsd.patches.db.statsd') as statsd_mock,
+        ):
+            db.report_query(self.connection, 'SELECT * FROM "app_a"', 'select', 1.0)
+            db.report_query(self.connection, 'SELECT * FROM "app_b"', 'select', 2.0)
+        self.assertEqual(
+            [args[0] for args, kwargs in statsd_mock.timing.call_args_list],
+            ['db.sqlite3.default.other.select', 'db.sqlite3.default.app_b.select'],
+        )
+
+
+class TestSlowQueries(TestCase):
+    def setUp(self):
+        self.connection = Mock(alias='default', client=Mock(executable_name='sqlite3'))
+        self.slow_queries = deque(maxlen=2)
+
+    def report(self, query, ms):
+        with (
+            patch.object(db, 'SLOW_QUERY_MS', 100),
+            patch.object(db, 'slow_queries', self.slow_queries),
+            patch('django_statsd.patches.db.statsd') as statsd_mock,
+        ):
+            db.report_query(self.connection, query, 'select', ms)
+        return statsd_mock
+
+    def test_slow_query(self):
+        statsd_mock = self.report("SELECT * FROM t WHERE name = 'secret'", 150.0)
+        statsd_mock.incr.assert_called_once_with('db.sqlite3.default.slow')
+        (query,) = self.slow_queries
+        self.assertEqual((query.alias, query.ms, query.sql), ('default', 150.0, 'SELECT * FROM t WHERE name = ?'))
+
+    def test_fast_query(self):
+        statsd_mock = self.report('SELECT 1', 99.0)
+        statsd_mock.incr.assert_not_called()
+        self.assertEqual(len(self.slow_queries), 0)
+
+    def test_reservoir_is_bounded(self):
+        for ms in (100, 200, 300):
+            self.report('SELECT 1', ms)
+        self.assertEqual([query.ms for query in self.slow_queries], [200, 300])
+
+    def test_command(self):
+        stdout = StringIO()
+        with (
+            patch.object(db, 'slow_queries', self.slow_queries),
+            patch('django_statsd.management.commands.statsd_slow_queries.call_command') as call_command_mock,
+        ):
+            call_command_mock.side_effect = lambda *args: self.assertEqual(db.SLOW_QUERY_MS, 5)
+            self.slow_queries.append(db.SlowQuery(0, 'default', 150.0, 'SELECT ?'))
+            call_command('statsd_slow_queries', '--threshold', '5', 'migrate', '--plan', stdout=stdout)
+        call_command_mock.assert_called_once_with('migrate', '--plan')
+        self.assertEqual(db.SLOW_QUERY_MS, None)
+        assert stdout.getvalue().endswith(' default 150.0ms SELECT ?\n')